@@ -1,28 +1,27 @@
 '''A clock that tells the time using images of quotes.'''
-import csv
 from datetime import datetime, timedelta
 import logging
 import random
 import signal
 import sys
+import threading
 import time
+from typing import Optional
 
 from PIL import Image
 
-from constants import ScreenOptions, SCREEN_TYPE, VCOM, STARTUP_MSG, BUFFER_SIZE, INCLUDE_CREDITS
-from image_generator import generate_img, QUOTES_PATH
+from constants import INCLUDE_CREDITS, QUOTES_DB_PATH, FRAME_STORE_PATH, PRODUCER_WAIT
+from displays import Frame, create_display
+from frame_store import STARTUP_SLOT, open_frame_store
+from image_generator import generate_img, render_settings_hash, QUOTES_PATH, STARTUP_ROW
+from quote_db import QuoteDatabase, open_quotes
+from quote_index import QuoteIndex, minute_of_day
+from quote_producer import QuoteProducer
+from scheduler import MinuteScheduler
 from writer import Pen
 
 logging.basicConfig(level=logging.DEBUG)
 
-if SCREEN_TYPE == ScreenOptions.IT8951:
-    from IT8951 import constants
-    from IT8951.display import AutoEPDDisplay
-elif SCREEN_TYPE == ScreenOptions.WAVESHARE:
-    from waveshare_libraries import epd7in5_V2 # Waveshare's library for their 7.5 inch screen
-else:
-    logging.error('Invalid option for SCREEN_TYPE.')
-
 class Clock:
     '''
     Determines which image should be displayed and when it should be displayed.
@@ -32,61 +31,59 @@ class Clock:
     it as possible).
 
     Attributes:
-        quotes (list[list[dict]]): Stores all rows of quotes from the CSV file.
-        quote_buffer (list[Image.Image]): A buffer that contains the images to be displayed for the
-         next BUFFER_SIZE minutes, including the currently displayed image.
-        epd (epd7in5_V2.EPD): Waveshare's EPD module to control a non-IT8951 screen and what is
-         displayed to it.
-        display (AutoEPDDisplay): The EPD module to control an IT8951 screen and what is displayed
-         to it.
+        quotes (QuoteDatabase | QuoteIndex): All rows of quotes, looked up by minute of the day.
+         Only loaded (by `cache_quotes()`) if there is no frame store.
+        store (FrameStore | None): Every quote, pre-rendered into frames for the screen (see
+         `frame_store.py`), or `None` if there isn't an up-to-date one for the screen.
+        producer (QuoteProducer): Gets the frames for the next `BUFFER_SIZE` minutes in the
+         background, encoded for the screen (see `quote_producer.py`). Its
+         `frames.hits` and `frames.misses` count how many minutes' frames were and weren't ready
+         in time.
+        current_frame (Frame | None): The frame that is on the screen.
+        fallbacks (int): The number of minutes that just the time was displayed for, because the
+         quote's image couldn't be rendered.
+        scheduler (MinuteScheduler): Decides when to update the screen for each minute.
+        screen (Display): The screen that quotes are drawn on, picked by `SCREEN_TYPE` (see
+         `displays.py`).
         pen (Pen): The pen that is passed into the image generation function to convert a quote's
-         row into an image.
+         row into an image. Each thread (i.e., the clock's and the producer's) has a pen of its
+         own, which is only created (loading a font) the first time that it renders a quote.
     '''
     def __init__(self):
-        self.quotes: list[list[dict]] = []
-        self.quote_buffer: list[Image.Image] = []
-        if SCREEN_TYPE == ScreenOptions.IT8951:
-            self.display = AutoEPDDisplay(vcom=VCOM)
-        elif SCREEN_TYPE == ScreenOptions.WAVESHARE:
-            self.epd = epd7in5_V2.EPD()
-
-        self.pen = Pen()
+        self.quotes: QuoteDatabase | QuoteIndex
+        self.producer = QuoteProducer(self.get_frame)
+        self.current_frame: Optional[Frame] = None
+        self.fallbacks = 0
+        self.scheduler = MinuteScheduler()
+        self.screen = create_display()
+        self.store = open_frame_store(FRAME_STORE_PATH, self.screen.frame_format,
+                                      render_settings_hash)
+        if self.store is not None:
+            logging.info('loaded %i frames from %s.', len(self.store), self.store.path)
+
+        self._local = threading.local()
         logging.info('created clock obj.')
 
+    @property
+    def pen(self) -> Pen:
+        '''The calling thread's pen.'''
+        if not hasattr(self._local, 'pen'):
+            self._local.pen = Pen()
+        return self._local.pen
+
     def cache_quotes(self):
-        '''Parses the CSV file containing all of the quotes and stores the rows in a list.
-        
-        Example structure:
-        ```Python
-        self.quotes = [
-            [0000_0 = {...}, 0000_1 = {...}], # rows for 00:00
-            [0001_0 = {...}, 0001_1 = {...}, ...] # rows for 00:01
-        ]
-        ```
-        TODO: Would it be better to store this in a JSON obj? Could be more memory efficient.
+        '''Load the quotes so that rows can be looked up by minute.
+
+        The compiled quote database is memory-mapped if it is up to date (see `quote_db.py`).
+        Otherwise, the CSV file containing all of the quotes is indexed; only the byte offset of
+        each row is kept in memory, and a row is decoded when it is selected (see `quote_index.py`).
         '''
-        curr_time = '00:00'
         try:
-            with open(QUOTES_PATH, newline='\n', encoding='UTF-8') as quotefile:
-                quotefile.seek(0)
-                quotereader = csv.DictReader(quotefile, delimiter='|')
-                min_rows: list[dict] = [] # all rows for a given minute
-                for row in quotereader:
-                    # roll over to next minute
-                    if int(row['time'][3:]) - 1 == int(curr_time[3:]):
-                        self.quotes.append(min_rows)
-                        min_rows = []
-                        curr_time = f'{curr_time[:2]}:{row["time"][3:]}'
-                    # roll over to next hour
-                    elif int(row['time'][:2]) - 1 == int(curr_time[:2]):
-                        self.quotes.append(min_rows)
-                        min_rows = []
-                        curr_time = f'{row["time"][:2]}:00'
-                    min_rows.append(row)
-            self.quotes.append(min_rows)
+            self.quotes = open_quotes(QUOTES_DB_PATH, QUOTES_PATH)
         except FileNotFoundError:
             logging.error('File %s not found', QUOTES_PATH)
             sys.exit(0)
+        logging.info('loaded %i quotes from %s.', len(self.quotes), self.quotes.path)
 
     def get_image(self, quote_time: datetime) -> Image.Image:
         '''
@@ -100,94 +97,102 @@ class Clock:
         Raises:
             FileNotFoundError: The path to the CSV of quotes is invalid.
         '''
-        minute = '0' + str(quote_time.minute) if quote_time.minute < 10 else str(quote_time.minute)
-        hour = '0' + str(quote_time.hour) if quote_time.hour < 10 else str(quote_time.hour)
-        usable_rows = []
         include_metadata = INCLUDE_CREDITS
 
-        rows_idx = int(hour) * 60 + int(minute) # index in self.quotes where quote_time's rows are
-        usable_rows:list[dict] = self.quotes[rows_idx]
-        selected_row = usable_rows[random.randrange(0, len(usable_rows))]
+        rows_idx = minute_of_day(quote_time.hour, quote_time.minute) # quote_time's slot in the index
+        selected_row = self.quotes.get_row(rows_idx, random.randrange(0, self.quotes.count(rows_idx)))
         quote_image = generate_img(selected_row, include_metadata, self.pen)
         return quote_image
 
-    def refresh_buffer(self):
-        '''Update the clock's buffer with one or more new images of quotes.
-        
-        First, the image at the front of the buffer is removed (it is for the previous minute).
-        Then, new quote(s) are added until the number of quotes in the buffer matches `BUFFER_SIZE`.
+    def get_frame(self, quote_time: datetime) -> Frame:
+        '''
+        Get the frame of a quote for the provided `quote_time`, ready to be drawn on the screen.
+
+        With a frame store, one of the minute's frames is selected at random and read straight out
+        of it. Otherwise, a quote is selected and rendered (see `get_image()`), then encoded.
+
+        Args:
+            quote_time (datetime): The time of day to get a quote's frame for.
+        Returns:
+            frame (Frame): The frame of the quote for the given time.
         '''
-        del self.quote_buffer[0]
-        curr_time = datetime.now()
-        curr_time = curr_time.replace(
-            minute=0) if curr_time.minute == 59 else curr_time.replace(minute=curr_time.minute + 1)
-
-        for i in range(BUFFER_SIZE - len(self.quote_buffer)):
-            quote_time = curr_time
-            difference = 60 - quote_time.minute - len(self.quote_buffer)
-            if difference <= 0:
-                quote_time = quote_time.replace(minute=abs(difference)) + timedelta(hours=1)
-            else:
-                quote_time = quote_time.replace(minute=quote_time.minute + len(self.quote_buffer))
-            self.quote_buffer.append(self.get_image(quote_time))
-
-
-    def display_quote(self):
+        if self.store is None:
+            return self.screen.encode(self.get_image(quote_time))
+        slot = minute_of_day(quote_time.hour, quote_time.minute)
+        return self.store.get_frame(slot, random.randrange(0, self.store.count(slot)))
+
+    def startup_frame(self) -> Frame:
+        '''Get the frame that is shown while the clock starts up.'''
+        if self.store is None:
+            return self.screen.encode(generate_img(STARTUP_ROW, False, self.pen))
+        return self.store.get_frame(STARTUP_SLOT, 0)
+
+    def fallback_image(self, quote_time: datetime) -> Image.Image:
+        '''Create an image of just the time, for when a quote's image can't be rendered.'''
+        time_string = quote_time.strftime('%H:%M')
+        row = {'quote': time_string, 'timestring': time_string, 'title': '', 'author': ''}
+        return generate_img(row, False, self.pen)
+
+    def display_quote(self, minute: datetime, wait: float = PRODUCER_WAIT):
         '''
-        Display the image at the front of the clock's buffer on the screen.
+        Display the image for `minute` on the screen.
+
+        The image is taken from the producer's buffer, already encoded into a frame for the
+        screen, waiting up to `wait` seconds for it. If it isn't ready, it is fetched now, and if
+        the producer has fallen behind, it starts over from the next minute. If it can't be
+        rendered, just the time is displayed.
 
         Raises:
             IOError: An error occurred when displaying the image on the screen.
         '''
+        frame = self.producer.take(minute, wait)
+        if frame is None:
+            logging.warning('No image is ready for %s. Rendering it now.', minute.strftime('%H:%M'))
+            if self.producer.is_behind(minute):
+                self.producer.restart(minute + timedelta(minutes=1))
+            try:
+                frame = self.get_frame(minute)
+            except Exception as e: # pylint: disable=broad-except
+                logging.error('Unable to render quote: %s. Displaying the time instead.', str(e))
+                self.fallbacks += 1
+                frame = self.screen.encode(self.fallback_image(minute))
+        self.current_frame = frame
         try:
-            if SCREEN_TYPE == ScreenOptions.IT8951:
-                self.display.frame_buf.paste(self.quote_buffer[0])
-                self.display.draw_full(constants.DisplayModes.GC16) # update display
-            elif SCREEN_TYPE == ScreenOptions.WAVESHARE:
-                self.epd.display(self.epd.getbuffer(self.quote_buffer[0]))
-                self.epd.sleep() # put screen to sleep to increase its lifespan
+            self.screen.show(frame)
         except IOError as e:
             logging.error('Unable to display image: %s', str(e))
             self.wipe_screen()
-            if SCREEN_TYPE == ScreenOptions.WAVESHARE:
-                self.epdconfig.module_exit(cleanup=True)
+            self.screen.close()
 
 
     def wipe_screen(self):
         '''Wipe the screen when something breaks to prevent ghosting.'''
         logging.info("clearing the screen…\n")
-        if SCREEN_TYPE == ScreenOptions.IT8951:
-            self.display.clear()
-        elif SCREEN_TYPE == ScreenOptions.WAVESHARE:
-            self.epd.init()  # wake the screen so that it can be cleared
-            self.epd.Clear()
+        self.screen.clear()
 
 
     def main(self):
-        '''Handles refreshing the screen, displaying quotes, and updating the clock's buffer.
+        '''Handles refreshing the screen and displaying quotes.
 
         This function is continuously called once every minute, and it performs four steps:
 
-        1. If it is the 59th minute of the hour, perform a full refresh. This helps prevent ghosting
-        and increases the screen's lifespan.
-        2. Display the image at the front of the clock's buffer on the screen.
-        3. Update the clock's buffer.
-        4. Sleep until the next minute. This is called one second early because of processing time
-        to update the screen with the next image.
+        1. Sleep until just before the next minute (see `scheduler.py`). The screen is updated
+        early by about as long as recent updates took, so that the quote appears on the minute.
+        2. If it is the start of an hour, perform a full refresh. This helps prevent ghosting and
+        increases the screen's lifespan.
+        3. Display the image for the minute on the screen. The producer gets the frames for the
+        next minutes in the background, so nothing needs to be rendered here.
+        4. Put the screen to sleep. Only the time until the screen showed the quote counts towards
+        how early the next update starts, not the hourly refresh or putting the screen to sleep.
         '''
-        if datetime.now().minute == 59:
+        minute = self.scheduler.wait()
+        if minute.minute == 0:
             logging.info('An hour has passed. Performing full refresh on screen.')
-            if SCREEN_TYPE == ScreenOptions.IT8951:
-                self.display.clear()
-            elif SCREEN_TYPE == ScreenOptions.WAVESHARE:
-                self.epd.init()
-                self.epd.Clear()
-        else:
-            if SCREEN_TYPE == ScreenOptions.WAVESHARE:
-                self.epd.init_fast() # speeds up displaying an image, according to Waveshare support
-        self.display_quote()
-        self.refresh_buffer()
-        time.sleep(59 - datetime.now().second)
+            self.screen.clear()
+        start = time.monotonic()
+        self.display_quote(minute)
+        self.scheduler.record_update(minute, time.monotonic() - start)
+        self.screen.sleep()
 
 
 def signal_handler(sig, frame):
@@ -203,8 +208,7 @@ def signal_handler(sig, frame):
     logging.info('sigint() called. Shutting clock down…\n')
     signal.signal(sig, signal.SIG_IGN)  # ignore additional signals
     clock.wipe_screen()
-    if SCREEN_TYPE == ScreenOptions.WAVESHARE:
-        clock.epdconfig.module_exit(cleanup=True)
+    clock.screen.close()
     sys.exit(0)
 
 
@@ -212,25 +216,21 @@ if __name__ == '__main__':
     try:
         logging.info("Literary Quote Clock Started")
         clock = Clock()
-        clock.cache_quotes()
+        if clock.store is None: # the quotes are only needed to render them
+            clock.cache_quotes()
 
         logging.info('Initializing and clearing the screen')
         clock.wipe_screen()
 
         logging.info('Displaying startup screen')
-        startup_row = {'quote': STARTUP_MSG,'timestring': STARTUP_MSG, 'title': '', 'author': ''}
-        startup_img = generate_img(startup_row, False, clock.pen)
-
-        if SCREEN_TYPE == ScreenOptions.IT8951:
-            clock.display.frame_buf.paste(startup_img)
-            clock.display.draw_full(constants.DisplayModes.GC16)
-        elif SCREEN_TYPE == ScreenOptions.WAVESHARE:
-            clock.epd.display(clock.epd.getbuffer(startup_img))
-            clock.epd.sleep()
+        clock.screen.show(clock.startup_frame())
+        clock.screen.sleep()
 
         time.sleep(30) # wait for the Pi's system clock to update after powering on (it has no RTC)
-        first_img = clock.get_image(datetime.now())
-        clock.quote_buffer.append(first_img)
+        now = datetime.now().replace(second=0, microsecond=0)
+        clock.producer.start(now)
+        clock.display_quote(now, wait=30) # the first image is rendered while the clock waits
+        clock.screen.sleep()
 
         # This is bad practice, but it ensures that anything I might've missed is caught
         # so that the screen can be cleared before the program exits.
@@ -241,13 +241,11 @@ if __name__ == '__main__':
         except Exception as e:
             logging.info('An error occured: %s', str(e))
             clock.wipe_screen()
-            if SCREEN_TYPE == ScreenOptions.WAVESHARE:
-                clock.epdconfig.module_exit(cleanup=True)
+            clock.screen.close()
             sys.exit(0)
 
     except KeyboardInterrupt as e:
         logging.info('Program interrupted: %s', str(e))
         clock.wipe_screen()
-        if SCREEN_TYPE == ScreenOptions.WAVESHARE:
-            clock.epdconfig.module_exit(cleanup=True)
+        clock.screen.close()
         sys.exit(0)
@@ -15,13 +15,53 @@ SCREEN_HEIGHT = 480
 STARTUP_MSG = 'Literary Quote Clock is Starting…'
 VCOM = -2.79 # FOR IT8951 SCREENS ONLY -- set to VCOM value that's on the screen's FPC
 
+# FOR IT8951 SCREENS ONLY -- only the part of the screen that changed is redrawn, with the fast
+# IT8951_FAST_MODE waveform if it's black and white ('DU', or 'A2', which is faster still but
+# ghosts more), or with GC16 if it has grey. Up to IT8951_GREY_TOLERANCE of its non-white pixels
+# may be grey (the anti-aliased edges of large black text are ~5-10%; grey text is ~90%); they're
+# rounded to black or white. After this many partial updates in a row (set to 0 to always redraw
+# the whole screen), the whole screen is redrawn with GC16 to clear up ghosting.
+IT8951_PARTIAL_LIMIT = 10
+IT8951_FAST_MODE = 'DU'
+IT8951_GREY_TOLERANCE = 0.25
+
 class ScreenOptions(Enum):
     '''docstring'''
-    IT8951    = 1
-    WAVESHARE = 2
+    IT8951      = 1
+    WAVESHARE   = 2
+    FILE        = 3 # save each frame to DISPLAY_PATH (no screen needed)
+    FRAMEBUFFER = 4 # write each frame to FRAMEBUFFER_PATH, e.g., an HDMI screen's /dev/fb0
 
 SCREEN_TYPE = ScreenOptions.WAVESHARE
 
+# FOR FILE AND FRAMEBUFFER SCREENS ONLY -- where frames are written. With a ring size above 1,
+# frames are saved to numbered files (frame_0.png, frame_1.png, ...), overwriting the oldest one. A
+# framebuffer path that isn't a /dev/fb* device is created as a shared memory file of 8-bit pixels.
+DISPLAY_PATH = 'display/frame.png'
+DISPLAY_RING_SIZE = 1
+FRAMEBUFFER_PATH = '/dev/fb0'
+
+# FOR WAVESHARE SCREENS ONLY -- draw images in 4 grays instead of black and white, so that grey
+# text (e.g., QUOTE_COLOR) isn't dithered. Only supported by screens sold after 24/10/23.
+WAVESHARE_4GRAY = False
+
+# FOR WAVESHARE SCREENS ONLY -- in black and white, only the part of the screen that changed is
+# refreshed, unless this many partial refreshes have been done in a row (set to 0 to always do a
+# full refresh), more than this fraction of the screen's pixels changed, or the rectangle around
+# the changed pixels covers more than this fraction of the screen
+PARTIAL_REFRESH_LIMIT = 5
+PARTIAL_REFRESH_THRESHOLD = 0.25
+PARTIAL_REFRESH_MAX_AREA = 0.5
+
+# FOR WAVESHARE SCREENS ONLY -- SPI clock speed. Raising it shortens each transfer, but long or
+# loose wires may need it lowered.
+SPI_SPEED_HZ = 4000000
+
+# FOR WAVESHARE SCREENS ONLY -- 'hardware', or 'mock' to simulate the screen (e.g., to run or
+# benchmark the clock on a computer without a screen). The EPD_BACKEND environment variable
+# overrides this.
+EPD_BACKEND = 'hardware'
+
 #############################
 # Image Config and Settings #
     # color is in RGB
@@ -32,10 +72,17 @@ TIME_COLOR   = 0   # timestring text is black
 CREDIT_COLOR = 0   # credit text is black
 
 QUOTES_PATH = 'quotes.csv'
+MY_QUOTES_PATH = 'misc/my-quotes.csv'
+QUOTES_DB_PATH = 'quotes.bin' # built by `python3 quote_db.py compile`
+# every quote, pre-rendered in the screen's frame format; built by `python3 image_generator.py
+# --store` (see frame_store.py). Set to '' to always render quotes on the Pi instead
+FRAME_STORE_PATH = 'frames.bin'
 IMAGE_PATH = 'images/'
 
 # for a list of all image formats that Pillow supports, see
 # https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#fully-supported-formats
+# 'epd' (1 bit per pixel) and 'epd4' (4 grays) save frames in the Waveshare panel's native layout,
+# which can be sent to the screen without any conversion (see frame_format.py)
 IMAGE_FORMAT = 'bmp'
 INCLUDE_CREDITS = True # print the quote's author and the book's title?
 
@@ -45,7 +92,24 @@ INCLUDE_CREDITS = True # print the quote's author and the book's title?
 MIN_FONT_SIZE = 12
 MAX_FONT_SIZE = 150 # depending on screen resolution, this may need to be changed
 
+# maximum number of loaded fonts to keep (each uses ~250 KB of RAM, and each font size uses four)
+FONT_CACHE_SIZE = 128
+
+LAYOUT_CACHE_PATH = 'layout_cache.sqlite3' # set to '' to disable the layout cache
+LAYOUT_CACHE_SIZE = 8192 # maximum number of cached layouts (each quote uses two)
+
 ################
 # Clock Config #
 ################
-BUFFER_SIZE = 3
+# number of minutes' quotes that are rendered ahead of time, in the background. Each is kept as a
+# frame in the screen's own format: 48 KB at 800x480 on Waveshare screens (96 KB in 4 grays) and
+# 192 KB on IT8951 screens, so an hour's worth takes 3-12 MB. Must divide the 1440 minutes in a
+# day (it's rounded down to a number that does)
+BUFFER_SIZE = 60
+PRODUCER_WAIT = 0.5 # seconds to wait for the producer to render a quote before rendering it itself
+
+# how many seconds before each minute the screen starts updating, to begin with; it's then adjusted
+# to how long updates take (up to MAX_LEAD_TIME), so that each quote appears right on the minute
+LEAD_TIME = 1.0
+MAX_LEAD_TIME = 20.0
+CLOCK_JUMP_TOLERANCE = 2.0 # changes to the system clock bigger than this (in seconds) are logged
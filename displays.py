@@ -0,0 +1,421 @@
+'''The screens that the clock can draw on, behind one interface.
+
+Each kind of screen in `ScreenOptions` has a `Display` class that knows how to draw a frame on it,
+clear it, and release it, so the clock doesn't need to know what it's drawing on:
+- `IT8951Display` and `WaveshareDisplay` drive e-paper screens.
+- `FileDisplay` saves each frame to an image file (or to a ring of files), and
+  `FramebufferDisplay` writes each frame into a Linux framebuffer (`/dev/fb*`, e.g., an HDMI
+  screen) or a shared memory file (e.g., in `/dev/shm`). These need no e-paper screen, so they can
+  be used to run the clock's real scheduling and rendering for soak and performance tests.
+
+Use `create_display()` to create the display that `SCREEN_TYPE` is set to.
+
+A display's `encode()` converts an image into a frame in the screen's own format (e.g., packed 1 bit
+per pixel for Waveshare screens), which is much smaller than the image and can be drawn without
+any conversion. The clock encodes each quote when it's rendered, ahead of time, and buffers frames
+rather than images.
+'''
+import fcntl
+import logging
+import mmap
+import os
+from os import path
+import struct
+import time
+from typing import Optional, Union
+
+from PIL import Image, ImageChops
+
+from constants import ScreenOptions, SCREEN_TYPE, SCREEN_WIDTH, SCREEN_HEIGHT, BG_COLOR, VCOM
+from constants import IT8951_PARTIAL_LIMIT, IT8951_FAST_MODE, IT8951_GREY_TOLERANCE
+from constants import WAVESHARE_4GRAY, PARTIAL_REFRESH_LIMIT, PARTIAL_REFRESH_THRESHOLD
+from constants import PARTIAL_REFRESH_MAX_AREA
+from constants import DISPLAY_PATH, DISPLAY_RING_SIZE, FRAMEBUFFER_PATH
+from frame_format import EPD_1BPP, EPD_4GRAY, FRAME_FORMATS, encode_1bpp, encode_4gray, encode_frame
+from frame_format import find_dirty_rect, save_image
+
+Frame = Union[bytes, Image.Image] # an image, encoded into a screen's own format by `encode()`
+
+BLACK_OR_WHITE = [0] * 128 + [255] * 128 # Image.point() table that rounds pixels to black or white
+FBIOGET_VSCREENINFO = 0x4600 # ioctl that reads a framebuffer's struct fb_var_screeninfo (160 bytes)
+# The start of struct fb_var_screeninfo: xres, yres, xres_virtual, yres_virtual, xoffset, yoffset
+VSCREENINFO = struct.Struct('=6I')
+VSCREENINFO_SIZE = 160
+
+
+class Display:
+    '''A screen that the clock draws frames on.
+
+    Attributes:
+        frames (int): The number of frames that have been drawn.
+        draw_time (float): The total time spent drawing frames, in seconds.
+        frame_format (str | None): The format in `frame_format.FRAME_FORMATS` that `encode()`
+         produces, or `None` if the screen's frames aren't in any of them. Frames that were encoded
+         ahead of time in this format (see `frame_store.py`) can be drawn as they are.
+    '''
+    def __init__(self):
+        self.frames = 0
+        self.draw_time = 0.0
+        self.frame_format: Optional[str] = None
+
+    def encode(self, image:Image.Image) -> Frame:
+        '''Convert an image into a frame that `draw()` can draw without any further conversion.
+
+        This doesn't touch the screen, so it can be called ahead of time, from any thread.
+        '''
+        return image
+
+    def show(self, frame:Frame):
+        '''Draw a frame (or an image, which is encoded first) on the screen, and log how long it
+        took. Returns as soon as the screen shows the frame; call `sleep()` afterwards.'''
+        start = time.perf_counter()
+        if isinstance(frame, Image.Image):
+            frame = self.encode(frame)
+        self.draw(frame)
+        elapsed = time.perf_counter() - start
+        self.frames += 1
+        self.draw_time += elapsed
+        logging.debug('%s drew frame %i in %.1f ms', type(self).__name__, self.frames,
+                      elapsed * 1000)
+
+    def draw(self, frame:Frame):
+        '''Draw a frame from `encode()` on the screen.'''
+        raise NotImplementedError
+
+    def clear(self):
+        '''Wipe the screen (e.g., to prevent ghosting, or before the clock exits).'''
+        raise NotImplementedError
+
+    def sleep(self):
+        '''Put the screen into its low-power state until the next frame, if it has one.'''
+
+    def close(self):
+        '''Release the screen's hardware or files.'''
+
+
+class IT8951Display(Display):
+    '''An e-paper screen with an IT8951 controller.
+
+    Only the rectangle that changed since the last frame is redrawn. If the new frame (and, for A2,
+    the old one) is black and white in that rectangle, it's drawn with `IT8951_FAST_MODE`;
+    otherwise it's drawn with GC16, which can show grey. Text is anti-aliased, so a rectangle counts
+    as black and white if at most `IT8951_GREY_TOLERANCE` of its non-white pixels are grey, and
+    those pixels are rounded to black or white before it's drawn. The whole screen is redrawn with GC16
+    instead if the screen was cleared or after `IT8951_PARTIAL_LIMIT` partial updates in a row.
+
+    Frames are packed at 4 bits per pixel, two pixels per byte (the left one in the high bits),
+    which is all that the controller uses of each pixel.
+
+    Attributes:
+        display (AutoEPDDisplay): The EPD module to control the screen.
+        last_image (Image.Image | None): The frame that is on the screen, or `None` if the screen
+         was cleared and needs a full update.
+        partial_updates (int): The number of partial updates since the last full update.
+    '''
+    def __init__(self):
+        super().__init__()
+        from IT8951.constants import DisplayModes # pylint: disable=import-outside-toplevel
+        from IT8951.display import AutoEPDDisplay # pylint: disable=import-outside-toplevel
+        self.modes = DisplayModes
+        self.fast_mode = getattr(DisplayModes, IT8951_FAST_MODE)
+        self.display = AutoEPDDisplay(vcom=VCOM)
+        self.last_image: Optional[Image.Image] = None
+        self.partial_updates = 0
+
+    def encode(self, image:Image.Image) -> bytes:
+        image = image.convert('L')
+        if image.width % 2: # each row must be a whole number of bytes
+            padded = Image.new('L', (image.width + 1, image.height), BG_COLOR)
+            padded.paste(image)
+            image = padded
+        left, right = Image.frombytes('LA', (image.width // 2, image.height),
+                                      image.tobytes()).split()
+        return ImageChops.add(left.point([v & 0xF0 for v in range(256)]),
+                              right.point([v >> 4 for v in range(256)])).tobytes()
+
+    @staticmethod
+    def is_black_and_white(image:Image.Image, tolerance:float = 0.0) -> bool:
+        '''Check if (all but `tolerance` of) the non-white pixels of an image are black on the
+        screen's 16 grays.'''
+        histogram = image.histogram()
+        grey = sum(histogram[16:240]) # the screen only uses a pixel's top 4 bits
+        return grey <= tolerance * (grey + sum(histogram[:16]))
+
+    def draw(self, frame:bytes):
+        start = time.perf_counter()
+        width = SCREEN_WIDTH + SCREEN_WIDTH % 2 # encode() pads odd widths by a column
+        image = Image.frombytes('L', (width, SCREEN_HEIGHT), frame, 'raw', 'L;4')
+        image = image.crop((0, 0, SCREEN_WIDTH, SCREEN_HEIGHT))
+        self.display.frame_buf.paste(image)
+        if self.last_image is None or self.partial_updates >= IT8951_PARTIAL_LIMIT:
+            self.display.draw_full(self.modes.GC16) # update display
+            self.partial_updates = 0
+            description = 'Full update'
+        else:
+            bbox = ImageChops.difference(self.last_image, image).getbbox()
+            if bbox is None:
+                logging.info('Image is unchanged. Skipping refresh.')
+                return
+            mode, mode_name = self.modes.GC16, 'GC16'
+            region = image.crop(bbox)
+            if self.is_black_and_white(region, IT8951_GREY_TOLERANCE) and (
+                    self.fast_mode != self.modes.A2
+                    or self.is_black_and_white(self.last_image.crop(bbox))):
+                mode, mode_name = self.fast_mode, IT8951_FAST_MODE
+                # round the grey pixels, so that the screen shows exactly what last_image holds
+                image.paste(region.point(BLACK_OR_WHITE), bbox[:2])
+                self.display.frame_buf.paste(image)
+            self.display.draw_partial(mode)
+            self.partial_updates += 1
+            description = f'Partial {mode_name} update of {bbox}'
+        self.last_image = image
+        logging.info('%s took %.1f ms.', description, (time.perf_counter() - start) * 1000)
+
+    def clear(self):
+        self.display.clear()
+        self.last_image = None # the next frame is drawn with a full update
+
+
+class WaveshareDisplay(Display):
+    '''A Waveshare 7.5" e-paper screen.
+
+    In 4-gray mode (`WAVESHARE_4GRAY`), the whole screen is always refreshed. In black and white,
+    only the rectangle that changed since the last frame is refreshed, which is faster and doesn't
+    flash the screen. A full refresh is done instead if the screen was cleared, after
+    `PARTIAL_REFRESH_LIMIT` partial refreshes in a row (to clear up ghosting), if more than
+    `PARTIAL_REFRESH_THRESHOLD` of the screen's pixels changed, or if the changed rectangle covers
+    more than `PARTIAL_REFRESH_MAX_AREA` of the screen. The panel forgets the frame it shows when
+    it sleeps, so the last frame's rectangle is sent along with the new one for a partial refresh.
+
+    Attributes:
+        epd (epd7in5_V2.EPD): Waveshare's EPD module to control the screen.
+        last_frame (bytes | None): The 1 bit per pixel frame that is on the screen, or `None` if
+         the screen was cleared (or is in 4-gray mode) and needs a full refresh.
+        partial_refreshes (int): The number of partial refreshes since the last full refresh.
+        awake (bool): Whether the screen was woken up since it was last put to sleep.
+    '''
+    def __init__(self):
+        super().__init__()
+        from waveshare_libraries import epd7in5_V2 # pylint: disable=import-outside-toplevel
+        self.epdconfig = epd7in5_V2.epdconfig
+        self.epd = epd7in5_V2.EPD()
+        self.frame_format = EPD_4GRAY if WAVESHARE_4GRAY else EPD_1BPP
+        self.last_frame: Optional[bytes] = None
+        self.partial_refreshes = 0
+        self.awake = False
+
+    def encode(self, image:Image.Image) -> bytes:
+        '''Convert an image into the bytes that `EPD.display()` (or, in 4-gray mode,
+        `EPD.display_4Gray()`) sends to the screen.'''
+        if WAVESHARE_4GRAY:
+            return encode_4gray(image, self.epd.width, self.epd.height)
+        return encode_1bpp(image, self.epd.width, self.epd.height)
+
+    def draw(self, frame:bytes):
+        '''Wake the screen and draw a frame on it. Returns once the refresh is done, leaving the
+        screen awake until `sleep()` is called.'''
+        if WAVESHARE_4GRAY:
+            self.epd.init_4Gray()
+            self.awake = True
+            self.epd.display_4Gray(frame)
+            return
+
+        dirty = None
+        if self.last_frame is not None and self.partial_refreshes < PARTIAL_REFRESH_LIMIT:
+            dirty = find_dirty_rect(self.last_frame, frame, self.epd.width, self.epd.height)
+            if dirty is None:
+                logging.info('Image is unchanged. Skipping refresh.')
+                return
+            screen_area = self.epd.width * self.epd.height
+            if dirty.changed_pixels > PARTIAL_REFRESH_THRESHOLD * screen_area or \
+               dirty.area > PARTIAL_REFRESH_MAX_AREA * screen_area:
+                dirty = None
+
+        if dirty is None:
+            self.epd.init_fast() # speeds up displaying an image, according to Waveshare support
+            self.awake = True
+            self.epd.display(frame)
+            self.partial_refreshes = 0
+        else:
+            logging.info('Partial refresh of (%i, %i)-(%i, %i), %i pixels changed.', dirty.x_start,
+                         dirty.y_start, dirty.x_end, dirty.y_end, dirty.changed_pixels)
+            self.epd.init_part()
+            self.awake = True
+            self.epd.display_Partial(dirty.crop(frame, self.epd.width), dirty.x_start,
+                                     dirty.y_start, dirty.x_end, dirty.y_end,
+                                     dirty.crop(self.last_frame, self.epd.width))
+            self.partial_refreshes += 1
+        self.last_frame = frame
+
+    def clear(self):
+        self.epd.init()  # wake the screen so that it can be cleared
+        self.awake = True
+        self.epd.Clear()
+        self.last_frame = None # the next frame is drawn with a full refresh
+
+    def sleep(self):
+        '''Put the screen to sleep to increase its lifespan. Powering it off and deep sleep take
+        over 2 s, which is why `draw()` doesn't do it.'''
+        if self.awake:
+            self.epd.sleep()
+            self.awake = False
+
+    def close(self):
+        self.epdconfig.module_exit(cleanup=True)
+
+
+class FileDisplay(Display):
+    '''Saves each frame to an image file, in any format that `frame_format.save_image()` supports.
+
+    With a ring of more than one file, frames are saved to numbered files (e.g., `frame_0.png`,
+    `frame_1.png`, ...), overwriting the oldest one. A frame is written to a temporary file first
+    and then renamed, so the file is never read half-written.
+
+    Attributes:
+        path (str): The file to save frames to, e.g., `display/frame.png`.
+        ring_size (int): The number of files to cycle through.
+    '''
+    def __init__(self, filepath:str = DISPLAY_PATH, ring_size:int = DISPLAY_RING_SIZE):
+        super().__init__()
+        self.path = filepath
+        self.ring_size = max(1, ring_size)
+        self._next = 0
+        extension = filepath.rsplit('.', 1)[-1].lower()
+        self.frame_format = extension if extension in FRAME_FORMATS else None
+        if path.dirname(filepath):
+            os.makedirs(path.dirname(filepath), exist_ok=True)
+
+    def next_path(self) -> str:
+        '''Return the file that the next frame is saved to.'''
+        if self.ring_size == 1:
+            return self.path
+        root, extension = path.splitext(self.path)
+        return f'{root}_{self._next}{extension}'
+
+    def encode(self, image:Image.Image) -> Frame:
+        '''Encode an image into a frame if frames are saved in a frame format (e.g., `.epd`).'''
+        return encode_frame(image, self.frame_format) if self.frame_format else image
+
+    def draw(self, frame:Frame):
+        filepath = self.next_path()
+        root, extension = path.splitext(filepath)
+        tmp_path = f'{root}.tmp{extension}' # keep the extension, which picks the file's format
+        if isinstance(frame, Image.Image):
+            save_image(frame, tmp_path)
+        else:
+            with open(tmp_path, 'wb') as frame_file:
+                frame_file.write(frame)
+        os.replace(tmp_path, filepath)
+        self._next = (self._next + 1) % self.ring_size
+
+    def clear(self):
+        self.draw(self.encode(Image.new('L', (SCREEN_WIDTH, SCREEN_HEIGHT), BG_COLOR)))
+
+
+class FramebufferDisplay(Display):
+    '''Writes each frame into a memory-mapped framebuffer.
+
+    For a Linux framebuffer device (`/dev/fb*`), its pixel format and row stride are read from
+    sysfs, and its visible resolution and panning offset from the driver; frames are centered on the
+    visible area (and shrunk if they don't fit), which may be smaller than the memory behind it
+    (e.g., when the framebuffer is double-buffered). Any other path is
+    treated as a shared memory file (e.g., `/dev/shm/literary-clock`) holding one 8-bit grayscale
+    frame, which another process can map and read.
+
+    Attributes:
+        path (str): The framebuffer device or shared memory file.
+        width (int): The framebuffer's visible width, in pixels.
+        height (int): The framebuffer's visible height, in pixels.
+        bits_per_pixel (int): 8 (grayscale), 16 (RGB565), 24 (BGR), or 32 (BGRX).
+        stride (int): The number of bytes in each row of the framebuffer.
+    '''
+    def __init__(self, fb_path:str = FRAMEBUFFER_PATH):
+        super().__init__()
+        self.path = fb_path
+        name = path.basename(fb_path)
+        sysfs = f'/sys/class/graphics/{name}'
+        if name.startswith('fb') and path.isdir(sysfs):
+            with open(f'{sysfs}/virtual_size', encoding='UTF-8') as size_file:
+                virtual_width, virtual_height = (int(n) for n in size_file.read().split(','))
+            with open(f'{sysfs}/bits_per_pixel', encoding='UTF-8') as bpp_file:
+                self.bits_per_pixel = int(bpp_file.read())
+            with open(f'{sysfs}/stride', encoding='UTF-8') as stride_file:
+                self.stride = int(stride_file.read())
+            fd = os.open(fb_path, os.O_RDWR)
+            try:
+                screen_info = fcntl.ioctl(fd, FBIOGET_VSCREENINFO, bytes(VSCREENINFO_SIZE))
+                self.width, self.height, _, _, x_offset, y_offset = VSCREENINFO.unpack_from(
+                    screen_info)
+            except OSError:
+                logging.warning('Could not read the visible resolution of %s, using its virtual '
+                                'size.', fb_path)
+                self.width, self.height, x_offset, y_offset = virtual_width, virtual_height, 0, 0
+        else:
+            self.width, self.height, self.bits_per_pixel = SCREEN_WIDTH, SCREEN_HEIGHT, 8
+            self.stride = SCREEN_WIDTH
+            virtual_height, x_offset, y_offset = SCREEN_HEIGHT, 0, 0
+            fd = os.open(fb_path, os.O_RDWR | os.O_CREAT, 0o644)
+            os.ftruncate(fd, self.stride * self.height)
+        if self.bits_per_pixel not in (8, 16, 24, 32):
+            os.close(fd)
+            raise ValueError(f'{fb_path} has an unsupported pixel format '
+                             f'({self.bits_per_pixel} bits per pixel)')
+        self._x_offset = x_offset * self.bits_per_pixel // 8 # bytes before the visible columns
+        self._offset = y_offset * self.stride # bytes before the visible rows
+        try:
+            self._mmap = mmap.mmap(fd, self.stride * virtual_height)
+        finally:
+            os.close(fd) # the mapping stays valid after the file is closed
+
+    def encode(self, image:Image.Image) -> bytes:
+        '''Convert a frame into the framebuffer's pixel format, one row per `stride` bytes.'''
+        image = image.convert('L')
+        if image.size != (self.width, self.height):
+            image.thumbnail((self.width, self.height))
+            canvas = Image.new('L', (self.width, self.height), 0)
+            canvas.paste(image, ((self.width - image.width) // 2,
+                                 (self.height - image.height) // 2))
+            image = canvas
+        if self.bits_per_pixel == 8:
+            data = image.tobytes()
+        elif self.bits_per_pixel == 16:
+            # RGB565, little-endian: a grey value v is (v >> 3) << 11 | (v >> 2) << 5 | (v >> 3)
+            low = image.point([((v >> 2) << 5 | (v >> 3)) & 0xFF for v in range(256)])
+            high = image.point([((v >> 3) << 3 | (v >> 5)) & 0xFF for v in range(256)])
+            data = Image.merge('LA', (low, high)).tobytes()
+        else:
+            rawmode = 'BGR' if self.bits_per_pixel == 24 else 'BGRX'
+            data = image.convert('RGB').tobytes('raw', rawmode)
+        row_bytes = len(data) // self.height
+        if row_bytes == self.stride:
+            return data
+        left = bytes(self._x_offset)
+        right = bytes(self.stride - self._x_offset - row_bytes)
+        return b''.join(left + data[y * row_bytes:(y + 1) * row_bytes] + right
+                        for y in range(self.height))
+
+    def draw(self, frame:bytes):
+        self._mmap[self._offset:self._offset + len(frame)] = frame
+
+    def clear(self):
+        self.draw(self.encode(Image.new('L', (SCREEN_WIDTH, SCREEN_HEIGHT), BG_COLOR)))
+
+    def close(self):
+        self._mmap.close()
+
+
+def create_display(screen_type:ScreenOptions = SCREEN_TYPE) -> Display:
+    '''Create the display for a type of screen.
+
+    Raises:
+        ValueError: `screen_type` isn't one of `ScreenOptions`.
+    '''
+    if screen_type == ScreenOptions.IT8951:
+        return IT8951Display()
+    if screen_type == ScreenOptions.WAVESHARE:
+        return WaveshareDisplay()
+    if screen_type == ScreenOptions.FILE:
+        return FileDisplay()
+    if screen_type == ScreenOptions.FRAMEBUFFER:
+        return FramebufferDisplay()
+    raise ValueError(f'Invalid option for SCREEN_TYPE: {screen_type}')
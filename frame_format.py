@@ -0,0 +1,187 @@
+'''Encode images into the Waveshare panel's native frame layout.
+
+Before an image can be sent to the panel, Waveshare's driver converts it to 1 bit per pixel and
+inverts every byte (`EPD.getbuffer()`), or, for 4 grays, maps it into two bit planes
+(`EPD.getbuffer_4Gray()`). Doing that once, when the images are generated, means that a frame can
+be sent to the panel as-is and that a day's worth of frames takes up a fraction of the space of
+8-bit images (48 KB instead of ~384 KB at 800x480).
+
+Frame formats (set `IMAGE_FORMAT` in `constants.py`, or pass `--format` to `image_generator.py`):
+- `epd`: 1 bit per pixel, 1 = black, rows packed MSB first. The bytes that `EPD.display()` takes.
+- `epd4`: 4 grays, as the two bit planes that `EPD.display_4Gray()` takes, one after the other
+  (RAM 0x10, then RAM 0x13). 96 KB at 800x480.
+
+Frame files are raw bytes with no header; their size is checked against the screen's resolution
+when they are loaded.
+'''
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image
+
+from constants import SCREEN_WIDTH, SCREEN_HEIGHT
+
+EPD_1BPP = 'epd'
+EPD_4GRAY = 'epd4'
+FRAME_FORMATS = (EPD_1BPP, EPD_4GRAY)
+
+# `bytes.translate()` table that flips every bit of a byte; Pillow's 1 = white, the panel's 1 = black
+INVERT = bytes(255 - i for i in range(256))
+
+
+def _gray_level(value:int) -> int:
+    '''Map an 8-bit pixel to one of the panel's 4 gray levels, the same way `getbuffer_4Gray()` does.
+
+    Returns:
+        level (int): 3 = white, 2 = light gray (0xC0), 1 = gray (0x80), 0 = black.
+    '''
+    if value == 0xC0:
+        value = 0x80
+    elif value == 0x80:
+        value = 0x40
+    return value >> 6
+
+# Lookup tables that turn an 8-bit image into each of `display_4Gray()`'s bit planes (255 = bit set)
+# The Waveshare driver uses these tables (and `INVERT`) too, so frames always match its output
+GRAY_PLANE_OLD = [255 if _gray_level(v) in (0, 2) else 0 for v in range(256)] # sent to RAM 0x10
+GRAY_PLANE_NEW = [255 if _gray_level(v) in (0, 1) else 0 for v in range(256)] # sent to RAM 0x13
+
+
+def frame_size(frame_format:str, width:int = SCREEN_WIDTH, height:int = SCREEN_HEIGHT) -> int:
+    '''Return the number of bytes in a frame.'''
+    plane = (width + 7) // 8 * height
+    return plane * 2 if frame_format == EPD_4GRAY else plane
+
+
+def _orient(image:Image.Image, width:int, height:int) -> Image.Image:
+    '''Rotate a portrait image to the panel's landscape orientation, like the driver does.
+
+    Raises:
+        ValueError: The image isn't `width`x`height` or `height`x`width`.
+    '''
+    if image.size == (width, height):
+        return image
+    if image.size == (height, width):
+        return image.rotate(90, expand=True)
+    raise ValueError(f'Wrong image dimensions {image.size}: must be {width}x{height}')
+
+
+def encode_1bpp(image:Image.Image, width:int = SCREEN_WIDTH, height:int = SCREEN_HEIGHT) -> bytes:
+    '''Encode an image into the bytes that `EPD.display()` sends to the panel.
+
+    The result is identical to `EPD.getbuffer()`: the image is dithered to 1 bit per pixel by
+    Pillow, then inverted.
+    '''
+    return _orient(image, width, height).convert('1').tobytes().translate(INVERT)
+
+
+def encode_4gray(image:Image.Image, width:int = SCREEN_WIDTH, height:int = SCREEN_HEIGHT) -> bytes:
+    '''Encode an image into the two bit planes that `EPD.display_4Gray()` sends to the panel.
+
+    The result is identical to `EPD.getbuffer_4Gray()`, and can be passed to `display_4Gray()`.
+    '''
+    image = _orient(image.convert('L'), width, height)
+    return image.point(GRAY_PLANE_OLD, '1').tobytes() + image.point(GRAY_PLANE_NEW, '1').tobytes()
+
+
+def encode_frame(image:Image.Image, frame_format:str) -> bytes:
+    '''Encode an image into a frame.
+
+    Raises:
+        ValueError: `frame_format` isn't one of `FRAME_FORMATS`, or the image is the wrong size.
+    '''
+    if frame_format == EPD_1BPP:
+        return encode_1bpp(image)
+    if frame_format == EPD_4GRAY:
+        return encode_4gray(image)
+    raise ValueError(f'Unknown frame format: {frame_format}')
+
+
+def save_image(image:Image.Image, filepath:str):
+    '''Save an image, as a frame if the file's extension is a frame format or with Pillow if not.'''
+    extension = filepath.rsplit('.', 1)[-1].lower()
+    if extension in FRAME_FORMATS:
+        with open(filepath, 'wb') as frame_file:
+            frame_file.write(encode_frame(image, extension))
+    else:
+        image.save(filepath)
+
+
+def load_frame(filepath:str) -> bytes:
+    '''Load a frame file, ready to be sent to the panel.
+
+    Raises:
+        ValueError: The file isn't a frame, or it was made for a different resolution.
+    '''
+    extension = filepath.rsplit('.', 1)[-1].lower()
+    if extension not in FRAME_FORMATS:
+        raise ValueError(f'{filepath} is not a frame file')
+    with open(filepath, 'rb') as frame_file:
+        frame = frame_file.read()
+    if len(frame) != frame_size(extension):
+        raise ValueError(f'{filepath} is {len(frame)} bytes, expected {frame_size(extension)}')
+    return frame
+
+
+@dataclass(frozen=True)
+class DirtyRect:
+    '''The rectangle of a 1 bit per pixel frame that changed since the previous frame.
+
+    Attributes:
+        x_start (int): The left edge, in pixels. Always a multiple of 8 (a whole byte).
+        y_start (int): The top edge, in pixels.
+        x_end (int): The right edge, in pixels (exclusive). Always a multiple of 8.
+        y_end (int): The bottom edge, in pixels (exclusive).
+        changed_pixels (int): The number of pixels that changed.
+    '''
+    x_start: int
+    y_start: int
+    x_end: int
+    y_end: int
+    changed_pixels: int
+
+    @property
+    def area(self) -> int:
+        '''The number of pixels in the rectangle.'''
+        return (self.x_end - self.x_start) * (self.y_end - self.y_start)
+
+    def crop(self, frame:bytes, width:int = SCREEN_WIDTH) -> bytes:
+        '''Copy the rectangle's rows out of a frame, for `EPD.display_Partial()`.'''
+        row_bytes = (width + 7) // 8
+        left, right = self.x_start // 8, self.x_end // 8
+        return b''.join(frame[y * row_bytes + left:y * row_bytes + right]
+                        for y in range(self.y_start, self.y_end))
+
+
+def find_dirty_rect(old:bytes, new:bytes, width:int = SCREEN_WIDTH,
+                    height:int = SCREEN_HEIGHT) -> Optional[DirtyRect]:
+    '''Find the smallest byte-aligned rectangle that contains every pixel that differs between two
+    1 bit per pixel frames.
+
+    The frames are XORed as two big integers, so the comparison runs in C rather than per byte.
+
+    Returns:
+        dirty_rect (DirtyRect | None): The changed rectangle, or `None` if the frames are identical.
+
+    Raises:
+        ValueError: The frames aren't the same size.
+    '''
+    if len(old) != len(new):
+        raise ValueError(f'Frames are different sizes: {len(old)} and {len(new)} bytes')
+    diff = int.from_bytes(old, 'big') ^ int.from_bytes(new, 'big')
+    if not diff:
+        return None
+    changed = diff.to_bytes(len(new), 'big')
+    row_bytes = (width + 7) // 8
+    first = len(changed) - len(changed.lstrip(b'\x00'))
+    last = len(changed.rstrip(b'\x00')) - 1
+    y_start, y_end = first // row_bytes, last // row_bytes + 1
+
+    left, right = row_bytes, 0
+    for y in range(y_start, y_end):
+        row = changed[y * row_bytes:(y + 1) * row_bytes]
+        stripped = row.rstrip(b'\x00')
+        if stripped:
+            left = min(left, len(row) - len(row.lstrip(b'\x00')))
+            right = max(right, len(stripped))
+    return DirtyRect(left * 8, y_start, right * 8, y_end, bin(diff).count('1'))
@@ -0,0 +1,251 @@
+'''A single file holding a pre-rendered frame of every quote, which the clock memory-maps.
+
+Every quote's frame is the same each time it is rendered, so a Pi doesn't need to run FreeType to
+render quotes at all. Instead, every quote can be rendered once, on any computer, and encoded in the
+screen's own format (see `frame_format.py`):
+
+```sh
+python3 image_generator.py --store               # frames.bin, in the format the screen uses
+python3 image_generator.py --store --format epd4 # 4 grays
+```
+
+The clock then memory-maps the file, and getting a quote's frame is an index lookup and a slice of
+the file. The frames are only read from disk when they are needed (and then stay in the page
+cache), so the clock starts up without loading the quotes or any fonts. If the file is missing,
+was built for a different screen, was rendered with different settings (fonts, colors, screen
+constants, etc.; see `image_generator.render_settings_hash()`), or if any of the quote files it was
+built from have changed since, the clock renders quotes itself instead until it is built again
+(unchanged frames are copied from the old file rather than rendered again).
+
+File layout (all integers are little-endian and unsigned):
+```
+header   magic 'LQFS', version (u16), n_sources (u16), frame format (8 bytes, e.g. 'epd'),
+         settings hash (SHA-256, 32 bytes), width (u16), height (u16), frame size (u32),
+         n_frames (u32), and the byte offset of each of the sections below (u32)
+sources  per source: path length (u16), UTF-8 path, mtime_ns (i64), size (u64), SHA-256 (32 bytes)
+slots    1441 x (first frame, frame count)  -- one entry per minute of the day, then the startup
+                                               screen
+hashes   n_frames x SHA-256 (32 bytes)      -- of the row and settings that each frame was
+                                               rendered from, so that unchanged frames can be
+                                               reused when the file is built again
+frames   n_frames x frame size bytes        -- starts on a page boundary
+```
+'''
+from array import array
+import logging
+import mmap
+import os
+import struct
+import sys
+from typing import Callable, Iterable, Optional
+
+from constants import SCREEN_WIDTH, SCREEN_HEIGHT
+from frame_format import frame_size
+from quote_db import pack_sources, unpack_sources, sources_changed
+from quote_index import MINUTES_PER_DAY
+
+MAGIC = b'LQFS'
+VERSION = 2
+HEADER = struct.Struct('<4sHH8s32sHHIIIIII')
+HASH_SIZE = 32
+STARTUP_SLOT = MINUTES_PER_DAY # the slot after the last minute of the day holds the startup screen
+N_SLOTS = MINUTES_PER_DAY + 1
+
+
+def write_frame_store(out_path:str, frame_format:str, settings:str, slot_counts:list[int],
+                      hashes:list[bytes], frames:Iterable[bytes], sources:list[tuple]) -> int:
+    '''Write a frame store.
+
+    Frames are written as they come out of `frames`, so they don't all need to be in memory.
+
+    Args:
+        out_path (str): Where to write the frame store.
+        frame_format (str): The format of the frames, one of `frame_format.FRAME_FORMATS`.
+        settings (str): The hex digest of the settings that the frames were rendered with (see
+         `image_generator.render_settings_hash()`).
+        slot_counts (list[int]): The number of frames for each minute of the day, and then for the
+         startup screen (`N_SLOTS` in all).
+        hashes (list[bytes]): The hash of the row (and settings) that each frame is rendered from.
+        frames (Iterable[bytes]): Every frame, in slot order.
+        sources (list[tuple]): `(path, mtime_ns, size, sha256)` of each quote file that the frames
+         were rendered from (see `quote_db.describe_source()`).
+
+    Returns:
+        n_frames (int): The number of frames written.
+
+    Raises:
+        ValueError: The slot counts, hashes, or frames don't add up.
+    '''
+    if len(slot_counts) != N_SLOTS or sum(slot_counts) != len(hashes):
+        raise ValueError(f'Expected {N_SLOTS} slots holding {len(hashes)} frames')
+    size = frame_size(frame_format)
+    slot_table = array('I')
+    first = 0
+    for count in slot_counts:
+        slot_table.extend((first, count))
+        first += count
+    if sys.byteorder != 'little':
+        slot_table.byteswap()
+
+    source_section = pack_sources(sources)
+    sources_off = HEADER.size
+    slots_off = sources_off + len(source_section)
+    slots_off += -slots_off % 4 # keep the slot table aligned so it can be cast without copying
+    hashes_off = slots_off + len(slot_table) * 4
+    frames_off = hashes_off + len(hashes) * HASH_SIZE
+    frames_off += -frames_off % mmap.PAGESIZE
+
+    tmp_path = f'{out_path}.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, VERSION, len(sources), frame_format.encode('UTF-8'),
+                              bytes.fromhex(settings), SCREEN_WIDTH, SCREEN_HEIGHT, size,
+                              len(hashes), sources_off, slots_off, hashes_off, frames_off))
+        out.write(source_section)
+        out.write(bytes(slots_off - sources_off - len(source_section)))
+        out.write(slot_table.tobytes())
+        out.write(b''.join(hashes))
+        out.write(bytes(frames_off - hashes_off - len(hashes) * HASH_SIZE))
+        n_frames = 0
+        for frame in frames:
+            if len(frame) != size:
+                raise ValueError(f'Frame {n_frames} is {len(frame)} bytes, expected {size}')
+            out.write(frame)
+            n_frames += 1
+    if n_frames != len(hashes):
+        os.remove(tmp_path)
+        raise ValueError(f'Expected {len(hashes)} frames, got {n_frames}')
+    os.replace(tmp_path, out_path) # a half-written frame store is never loaded
+    return n_frames
+
+
+class FrameStore:
+    '''A frame store, memory-mapped and read in place.
+
+    Attributes:
+        path (str): The path to the frame store.
+        frame_format (str): The format of the frames, one of `frame_format.FRAME_FORMATS`.
+        settings (str): The hex digest of the settings that the frames were rendered with.
+        width (int): The width of the screen that the frames were rendered for, in pixels.
+        height (int): The height of the screen that the frames were rendered for, in pixels.
+        frame_size (int): The number of bytes in each frame.
+        sources (list[tuple]): `(path, mtime_ns, size, sha256)` for each quote file that the frames
+         were rendered from.
+
+    Raises:
+        ValueError: The file is not a frame store, or it was written by a different version.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as store_file:
+            self._mmap = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, n_sources, frame_format, settings, self.width, self.height,
+             self.frame_size, self._n_frames, sources_off, slots_off, self._hashes_off,
+             self._frames_off) = HEADER.unpack_from(self._mmap, 0)
+        except struct.error as e:
+            self._mmap.close()
+            raise ValueError(f'{path} is not a frame store') from e
+        if magic != MAGIC or version != VERSION or sys.byteorder != 'little':
+            self._mmap.close()
+            raise ValueError(f'{path} is not a version {VERSION} frame store')
+        if len(self._mmap) < self._frames_off + self._n_frames * self.frame_size:
+            self._mmap.close()
+            raise ValueError(f'{path} is truncated')
+
+        self.frame_format = frame_format.rstrip(b'\0').decode('UTF-8')
+        self.settings = settings.hex()
+        self.sources = unpack_sources(self._mmap, sources_off, n_sources)
+        self._view = memoryview(self._mmap)
+        self._slots = self._view[slots_off:self._hashes_off].cast('I')
+        if hasattr(mmap, 'MADV_RANDOM'):
+            self._mmap.madvise(mmap.MADV_RANDOM) # one frame is read at a time; don't read ahead
+
+    def is_stale(self) -> bool:
+        '''Check if any of the quote files that the frames were rendered from have changed (see
+        `quote_db.sources_changed()`).'''
+        return sources_changed(self.sources)
+
+    def __len__(self) -> int:
+        return self._n_frames
+
+    def count(self, slot:int) -> int:
+        '''Return the number of frames for a minute of the day (or `STARTUP_SLOT`).'''
+        return self._slots[2 * slot + 1]
+
+    def _index(self, slot:int, n:int) -> int:
+        if not 0 <= n < self._slots[2 * slot + 1]:
+            raise IndexError(f'slot {slot} has no frame {n}')
+        return self._slots[2 * slot] + n
+
+    def get_frame(self, slot:int, n:int) -> bytes:
+        '''Read a frame, ready to be drawn on the screen.
+
+        Args:
+            slot (int): The minute of the day (0-1439) to get a frame for, or `STARTUP_SLOT`.
+            n (int): Which of the slot's frames to get.
+
+        Raises:
+            IndexError: The slot does not have an `n`th frame.
+        '''
+        start = self._frames_off + self._index(slot, n) * self.frame_size
+        return self._mmap[start:start + self.frame_size]
+
+    def frames_by_hash(self) -> dict[bytes, int]:
+        '''Map the hash of each frame's row to the frame's index, to find reusable frames.'''
+        hashes = self._mmap[self._hashes_off:self._hashes_off + self._n_frames * HASH_SIZE]
+        return {hashes[i * HASH_SIZE:(i + 1) * HASH_SIZE]: i for i in range(self._n_frames)}
+
+    def get_frame_at(self, index:int) -> bytes:
+        '''Read the `index`th frame in the file.'''
+        start = self._frames_off + index * self.frame_size
+        return self._mmap[start:start + self.frame_size]
+
+    def close(self):
+        '''Unmap the frame store.'''
+        self._slots.release()
+        self._view.release()
+        self._mmap.close()
+
+
+def open_frame_store(path:str, frame_format:Optional[str],
+                     settings:Callable[[str], str]) -> Optional[FrameStore]:
+    '''Open the frame store, if it can be used for a screen.
+
+    Args:
+        path (str): The path to the frame store. An empty path disables the frame store.
+        frame_format (str | None): The frame format that the screen takes (see
+         `Display.frame_format`), or `None` if it doesn't take any of them.
+        settings (Callable[[str], str]): Returns the hex digest of the settings that quotes are
+         rendered with in a frame format (i.e., `image_generator.render_settings_hash()`). Only
+         called if there is a frame store to check.
+
+    Returns:
+        frame_store (FrameStore | None): The frame store, or `None` if it is disabled, missing,
+        out of date, or for a different screen.
+    '''
+    if not path or frame_format is None:
+        return None
+    try:
+        store = FrameStore(path)
+    except FileNotFoundError:
+        logging.info('%s not found, rendering quotes instead.', path)
+        return None
+    except ValueError as e:
+        logging.warning('%s, rendering quotes instead.', str(e))
+        return None
+
+    if (store.frame_format, store.width, store.height) != (frame_format, SCREEN_WIDTH,
+                                                           SCREEN_HEIGHT):
+        logging.warning('%s holds %ix%i %s frames, but the screen takes %ix%i %s frames. Rendering '
+                        'quotes instead.', path, store.width, store.height, store.frame_format,
+                        SCREEN_WIDTH, SCREEN_HEIGHT, frame_format)
+    elif store.settings != settings(frame_format):
+        logging.warning('%s was rendered with different fonts, colors, or settings (run `python3 '
+                        'image_generator.py --store`), rendering quotes instead.', path)
+    elif store.is_stale():
+        logging.warning('%s is out of date (run `python3 image_generator.py --store`), rendering '
+                        'quotes instead.', path)
+    else:
+        return store
+    store.close()
+    return None
@@ -12,73 +12,104 @@ actually used) -- can use one delim for bold and italic. just track total number
 num % 2 == 0 then bold otherwise italic if num > 0
 https://stackoverflow.com/questions/43060479/how-to-get-the-font-pixel-height-using-pils-imagefont-class
 '''
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import csv
+from glob import glob
+import hashlib
+import json
 import logging
 import os
 from os import path
-from sys import argv
-from typing import Optional
+import sys
+from typing import Iterator, Optional
 
 from PIL import Image, ImageDraw, ImageFont
 
 from constants import SCREEN_WIDTH, SCREEN_HEIGHT
-from constants import QUOTE_COLOR, TIME_COLOR, BG_COLOR, IMAGE_FORMAT, INCLUDE_CREDITS
-from constants import QUOTES_PATH, IMAGE_PATH
+from constants import QUOTE_COLOR, TIME_COLOR, CREDIT_COLOR, BG_COLOR, IMAGE_FORMAT, INCLUDE_CREDITS
+from constants import QUOTES_PATH, IMAGE_PATH, FRAME_STORE_PATH, STARTUP_MSG, WAVESHARE_4GRAY
 from constants import MIN_FONT_SIZE, MAX_FONT_SIZE
 
+from frame_format import EPD_1BPP, EPD_4GRAY, FRAME_FORMATS, encode_frame, frame_size, save_image
+from frame_store import FrameStore, write_frame_store
+from layout_cache import get_layout_cache, layout_fingerprint
+from quote_db import QuoteDatabase, describe_source, open_quotes
+from quote_index import MINUTES_PER_DAY
 from writer import BoundingBox
 from writer import CharacterDelimiters
 from writer import Fonts
-from writer import FontPath
+from writer import FontStyle
+from writer import font_registry
 from writer import Pen
+from writer import Run
 from writer import TextType
+from writer import tokenize
+from writer import Word
 from writer import WordDelimiters
 
 logging.basicConfig(level=logging.DEBUG)
 
+LINE_SPACING = 4 # pixels between lines of text (Pillow's default for multiline text)
 
-def format_char(char:str, fonts:Fonts, pen:Pen) -> str:
-    '''Determine the font and color to write a character with.
+# Records the hash of each image's row, so that only changed rows are rendered again
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
 
-    If the character is a delimiter, an empty string is returned.
+# The screen that is shown while the clock starts up
+STARTUP_ROW = {'time': '', 'quote': STARTUP_MSG, 'timestring': STARTUP_MSG, 'title': '',
+               'author': ''}
 
-    Args:
-        char (str): The character to be written.
-        fonts (Fonts): Contains the possible fonts that may be used to write the character.
-        pen (Pen): The pen used to write the character to the image.
-    
-    Returns:
-      char (str): An empty string if the passed in character is a delimiting character. Otherwise,
-      the `char` that is passed in by the caller is returned back.
+
+def get_lineheight(font:ImageFont.FreeTypeFont) -> int:
+    '''Return the distance (in pixels) from the top of one line of text to the top of the next.
+
+    This is the same line spacing that Pillow uses for multiline text: the bottom of an "A", plus
+    `LINE_SPACING`. It's measured once per font and kept in the font registry, which drops it when
+    the font is evicted.
     '''
-    italic_count = 0 # determines if the font should be bold or italic-bold
-    found_delimiter = False
+    line_height = font_registry.line_heights.get(font)
+    if line_height is None:
+        line_height = font_registry.line_heights[font] = int(font.getbbox('A')[3] + LINE_SPACING)
+    return line_height
 
-    # check each delimiter and update their counters as needed, along with the pen's font and color
-    for delim in pen.char_delimiters:
-        if char in (dir(WordDelimiters())):
-            return ''
-        if char == delim.character:
-            delim.count += 1
-            char = ''
-        if delim.count == 1:
-            found_delimiter = True # not necessarily true, but prevents font from being reset to regular prematurely
-            if delim.character == CharacterDelimiters.ITALIC:
-                italic_count = delim.count
-                pen.font = fonts.italic
-                pen.color = QUOTE_COLOR
-            elif delim.character in (CharacterDelimiters.BOLD, CharacterDelimiters.TIMESTR):
-                pen.font = fonts.italic_bold if italic_count > 0 else fonts.bold
-                pen.color = TIME_COLOR
-        elif delim.count >= 2:
-            delim.count = 0
-            found_delimiter = True
-
-    if not found_delimiter:
-        pen.font = fonts.regular
-        pen.color = QUOTE_COLOR if pen.text_type == TextType.QUOTE else TIME_COLOR
-
-    return char
+
+def fits_height(lines:list[str], font:ImageFont.FreeTypeFont, bbox:BoundingBox) -> bool:
+    '''Check if lines of text fit above the bottom of a bbox when they are written in a font.
+
+    This gives the same answer as comparing the bottom of `ImageDraw.multiline_textbbox()` to the
+    bbox, without having to create an image to measure the text on. Each line starts
+    `get_lineheight()` below the last one, and no character reaches further below the top of its
+    line than the font's ascent + descent. So, working up from the last line, only the lines that
+    could cross the bottom of the bbox are measured exactly.
+
+    Args:
+        lines (list[str]): The lines of text, in order from top to bottom.
+        font (ImageFont.FreeTypeFont): The font that the text is measured in.
+        bbox (BoundingBox): The bbox that the text is written in, starting at its top left corner.
+    '''
+    line_height = get_lineheight(font)
+    ascent, descent = font.getmetrics()
+    for i in range(len(lines) - 1, -1, -1):
+        line_top = bbox.top_left_y + i * line_height
+        if line_top + ascent + descent <= bbox.bottom_right_y:
+            return True # this line, and every line above it, fits
+        if line_top + font.getbbox(lines[i])[3] > bbox.bottom_right_y:
+            return False
+    return True
+
+
+def get_color(style:FontStyle, text_type:TextType) -> int:
+    '''Determine the color to write a run of text with.
+
+    Bold text (including the timestring) is written in `TIME_COLOR`, and italic text is written in
+    `QUOTE_COLOR`. Regular text is written in `QUOTE_COLOR` in a quote, and `TIME_COLOR` in credits.
+    '''
+    if style in (FontStyle.BOLD, FontStyle.ITALIC_BOLD):
+        return TIME_COLOR
+    if style == FontStyle.ITALIC:
+        return QUOTE_COLOR
+    return QUOTE_COLOR if text_type == TextType.QUOTE else TIME_COLOR
 
 def format_word(word:str, lines:list[str], word_len:int, pen:Pen):
     '''Check if a word needs to be moved onto a new line, either due to text wrapping or formatting.
@@ -94,26 +125,25 @@ def format_word(word:str, lines:list[str], word_len:int, pen:Pen):
         add_line = True
     elif WordDelimiters.DOUBLE_NEWLINE in word:
         add_line = True
-        pen.coords['y'] += int(pen.font.getbbox("A")[3] + 4)
+        pen.coords['y'] += get_lineheight(pen.font)
         lines.append(' ')
 
     if pen.coords['x'] + word_len > pen.bbox.bottom_right_x or add_line:
         # move to the next line, add the current word to the line, and reset x coord
-        # TODO: Replace with get_lineheight()
         pen.coords['x'] = pen.bbox.top_left_x
-        pen.coords['y'] += int(pen.font.getbbox("A")[3] + 4)
+        pen.coords['y'] += get_lineheight(pen.font)
         lines.append(word)
     else:
         # add the current word to the current line
         lines[-1] = f'{lines[-1]} {word}'
 
 
-def wrap_text(text: str, fonts: Fonts, pen: Pen) -> str:
+def wrap_text(words: tuple[Word, ...], fonts: Fonts, pen: Pen) -> str:
     '''Helper to `find_optimal_font_size()`. Wraps text so that it doesn't overflow past the
     rightmost x coordinate of the bbox.
 
     Args:
-        text (str): The text to be wrapped.
+        words (tuple[Word, ...]): The tokenized text to be wrapped.
         fonts (Fonts): Contains the possible fonts that may be used to write the word.
         pen (Pen): The pen used to write the text.
 
@@ -124,25 +154,23 @@ def wrap_text(text: str, fonts: Fonts, pen: Pen) -> str:
     pen.coords['x'] = pen.bbox.top_left_x
     pen.coords['y'] = pen.bbox.top_left_y
 
-    # Iterate over the text character-by-character and try to place each word on the current line.
+    # Iterate over the text word-by-word and try to place each word on the current line.
     # If the word cannot fit, move down one line and place it there instead. Then, move the pen
     # right to write the next word.
-    words = text.split()
+    advances = font_registry.advances
     for word in words:
         word_len = 0
-        for char in word:
-            char = format_char(char, fonts, pen)
-            if char == '':
-                continue
-            word_len += int(pen.font.getlength(char))
+        for run in word.runs:
+            word_len += advances[fonts.get(run.style)].text_width(run.text)
 
         # a single word cannot be longer than one line
         if word_len > pen.bbox.bottom_right_x - pen.bbox.top_left_x:
             pen.reset(pen.bbox.top_left_x, pen.bbox.top_left_y)
             return ''
 
-        word_len += int(pen.font.getlength(' ')) # simulate space after word
-        format_word(word, lines, word_len, pen)
+        pen.font = fonts.get(word.trailing_style)
+        word_len += advances[pen.font][' '] # simulate space after word
+        format_word(word.text, lines, word_len, pen)
         pen.coords['x'] += word_len
 
         # current wrapping writes text past bbox (need to reduce font size)
@@ -150,25 +178,19 @@ def wrap_text(text: str, fonts: Fonts, pen: Pen) -> str:
             pen.reset(pen.bbox.top_left_x, pen.bbox.top_left_y)
             return ''
 
-    wrapped = '\n'.join(lines)
-
-    # TODO: figure out how pillow calculates bbox and manually implement height calculation so that I dont have to make an objects each time
     # verify that the wrapping fits
-    temp_img = Image.new(mode='L', size=(SCREEN_WIDTH, SCREEN_HEIGHT), color=BG_COLOR)
-    canvas = ImageDraw.Draw(temp_img)
-    pil_bbox = canvas.multiline_textbbox((pen.bbox.top_left_x, pen.bbox.top_left_y), wrapped, fonts.regular)
-
-    if pil_bbox[3] > pen.bbox.bottom_right_y:
+    if not fits_height(lines, fonts.regular, pen.bbox):
         pen.reset(pen.bbox.top_left_x, pen.bbox.top_left_y)
         return ''
-    return wrapped
+    return '\n'.join(lines)
 
 
-def find_optimal_font_size(text: str, bbox: BoundingBox, text_type: TextType) -> tuple[int, str]:
+def find_optimal_font_size(words: tuple[Word, ...], bbox: BoundingBox,
+                           text_type: TextType) -> tuple[int, str]:
     '''Find the maximum possible font size that the text can be written in for a given bounding box.
 
     Args:
-        text (str): The text to fit inside the bounding box.
+        words (tuple[Word, ...]): The tokenized text to fit inside the bounding box.
         bbox (BoundingBox): A bounding box to fill with the text.
         text_type (TextType): Tells the function if the text is a quote or credits.
 
@@ -185,22 +207,14 @@ def find_optimal_font_size(text: str, bbox: BoundingBox, text_type: TextType) ->
 
     temp_pen = Pen()
     temp_pen.bbox = bbox
-    temp_pen.text = text
 
     # use binary search to find optimal font size
     while min_size <= max_size:
         mid_size = min_size + (max_size - min_size) // 2
         lines = ""
 
-        fonts = Fonts(
-            regular=ImageFont.truetype(FontPath.REGULAR, mid_size, ImageFont.Layout.BASIC),
-            bold=ImageFont.truetype(FontPath.BOLD, mid_size, ImageFont.Layout.BASIC),
-            italic=ImageFont.truetype(FontPath.ITALIC, mid_size, ImageFont.Layout.BASIC),
-            italic_bold=ImageFont.truetype(FontPath.ITALIC_BOLD, mid_size, ImageFont.Layout.BASIC),
-            credit=ImageFont.truetype(FontPath.CREDIT, mid_size, ImageFont.Layout.BASIC)
-        )
-        temp_pen.font = fonts.regular
-        lines = wrap_text(text, fonts, temp_pen)
+        fonts = font_registry.get_fonts(mid_size)
+        lines = wrap_text(words, fonts, temp_pen)
         if lines:
             optimal_size = mid_size
             min_size = mid_size + 1
@@ -211,8 +225,7 @@ def find_optimal_font_size(text: str, bbox: BoundingBox, text_type: TextType) ->
     lines_height = 0 # sum of all lines
     line_width = 0 # length of the longest line.
     for line in best_fit_lines.splitlines():
-        # TODO: Replace with get_lineheight()
-        lines_height += int(fonts.regular.getbbox("A")[3] + 4)
+        lines_height += get_lineheight(fonts.regular)
         curr_line_width = int(fonts.regular.getlength(line))
         if curr_line_width > line_width:
             line_width = curr_line_width
@@ -224,32 +237,47 @@ def find_optimal_font_size(text: str, bbox: BoundingBox, text_type: TextType) ->
     return (optimal_size, best_fit_lines)
 
 
-def draw_word(img: Image.Image, word: str, fonts: Fonts, pen: Pen):
-    '''Draw a word onto an image character-by-character.
-    
+def draw_line(canvas: ImageDraw.ImageDraw, words: list[Word], fonts: Fonts, pen: Pen):
+    '''Draw a line of words onto an image, one segment of same-style text at a time.
+
+    Consecutive runs (and the spaces between words) that are written in the same style are joined
+    into a segment, so most lines are drawn with only a few calls to Pillow. A character whose bbox
+    would overlap a character already in the segment (e.g., an italic "f") starts a new segment
+    instead, because Pillow blends overlapping characters differently when they are drawn in a
+    single call, and the image would no longer match one that is drawn character-by-character.
+
     Args:
-        img (Image.Image): The image object the word is drawn onto.
-        word (str): The word to be drawn.
-        fonts (Fonts): Contains the possible fonts that may be used to write the word.
-        pen (Pen): The pen used to write the word.
+        canvas (ImageDraw.ImageDraw): The drawing context of the image the line is drawn onto.
+        words (list[Word]): The tokenized words to be drawn.
+        fonts (Fonts): Contains the possible fonts that may be used to write the words.
+        pen (Pen): The pen used to write the words.
     '''
-    canvas = ImageDraw.Draw(img)
-    write = canvas.text
-    for char in word:
-        char = format_char(char, fonts, pen)
-        if char == '':
-            continue
-        write((pen.coords['x'], pen.coords['y']), char, pen.color, pen.font)
-        pen.coords['x'] += int(pen.font.getlength(char))
-
-    # add a space after each word
-    write((pen.coords['x'], pen.coords['y']), ' ', pen.color, pen.font)
-    pen.coords['x'] += int(pen.font.getlength(' '))
-
-    for delimiter in pen.char_delimiters:
-        if delimiter.count >= 2:
-            delimiter.count = 0
-            pen.font = fonts.regular
+    segments: list[list] = [] # [x, text, style] of each segment
+    segment_right = 0 # the rightmost edge of the current segment's characters
+    x = pen.coords['x']
+    for word in words:
+        # add a space after each word
+        for run in (*word.runs, Run(' ', word.trailing_style)):
+            font = fonts.get(run.style)
+            widths = font_registry.advances[font]
+            extents = font_registry.extents[font]
+            for char in run.text:
+                left, right = extents[char]
+                if segments and segments[-1][2] == run.style and x + left >= segment_right:
+                    segments[-1][1] += char
+                else:
+                    segments.append([x, char, run.style])
+                    segment_right = x
+                if left != right:
+                    segment_right = max(segment_right, x + right)
+                x += widths[char]
+
+    for segment_x, text, style in segments:
+        pen.font = fonts.get(style)
+        pen.color = get_color(style, pen.text_type)
+        if not text.isspace():
+            canvas.text((segment_x, pen.coords['y']), text, pen.color, pen.font)
+    pen.coords['x'] = x
 
 def find_timestr_indices(pen:Pen, timestr: str):
     '''Find the indices where the timestring begins and ends in the quote.'''
@@ -258,11 +286,11 @@ def find_timestr_indices(pen:Pen, timestr: str):
     return (timestr_begin, timestr_end)
 
 
-def write_in_bbox(img: Image.Image, pen: Pen, timestr: Optional[str] = ""):
+def write_in_bbox(canvas: ImageDraw.ImageDraw, pen: Pen, timestr: Optional[str] = ""):
     '''Write text inside of a bounding box.
 
     Args:
-        img (Image.Image): The Image to write the text on.
+        canvas (ImageDraw.ImageDraw): The drawing context of the image to write the text on.
         pen (Pen): The pen used to write the quote.
         timestr (Optional[str]): A substring that contains the quote's time.
 
@@ -289,29 +317,39 @@ def write_in_bbox(img: Image.Image, pen: Pen, timestr: Optional[str] = ""):
         pen.text = quote
 
 
-    optimal_fontsize, wrapped_lines = find_optimal_font_size(pen.text, pen.bbox, pen.text_type)
+    words = tokenize(pen.text)
+
+    # The layout only depends on the text and where it is written, so it may already be cached.
+    layout_cache = get_layout_cache()
+    layout = None
+    if layout_cache:
+        layout_key = layout_cache.key(pen.text, pen.bbox, pen.text_type)
+        layout = layout_cache.get(layout_key)
+    if layout:
+        optimal_fontsize, wrapped_lines, coords = layout
+        (pen.bbox.top_left_x, pen.bbox.top_left_y,
+         pen.bbox.bottom_right_x, pen.bbox.bottom_right_y) = coords
+    else:
+        optimal_fontsize, wrapped_lines = find_optimal_font_size(words, pen.bbox, pen.text_type)
+        if layout_cache:
+            layout_cache.put(layout_key, optimal_fontsize, wrapped_lines, pen.bbox)
 
     if optimal_fontsize <= MIN_FONT_SIZE:
         bbox_repr = repr(pen.bbox)
         logging.error('Text starting with "%s..." is too long and doesn\'t fit in bbox=%s with' \
         'minimum font=%i', pen.text[:30], bbox_repr, MIN_FONT_SIZE)
 
-    fonts = Fonts(
-        regular=ImageFont.truetype(FontPath.REGULAR, optimal_fontsize, ImageFont.Layout.BASIC),
-        bold=ImageFont.truetype(FontPath.BOLD, optimal_fontsize, ImageFont.Layout.BASIC),
-        italic=ImageFont.truetype(FontPath.ITALIC, optimal_fontsize, ImageFont.Layout.BASIC),
-        italic_bold=ImageFont.truetype(FontPath.ITALIC_BOLD, optimal_fontsize, ImageFont.Layout.BASIC),
-        credit=ImageFont.truetype(FontPath.CREDIT, optimal_fontsize, ImageFont.Layout.BASIC)
-    )
+    fonts = font_registry.get_fonts(optimal_fontsize)
 
+    # the wrapped lines contain the same words as the text, in the same order
+    word_num = 0
     pen.coords['y'] = pen.bbox.top_left_y
     for line in wrapped_lines.splitlines():
         pen.coords['x'] = pen.bbox.top_left_x
-        words = line.split()
-        for word in words:
-            draw_word(img, word, fonts, pen)
-        # TODO: Replace with get_lineheight()
-        pen.coords['y'] += int(pen.font.getbbox("A")[3] + 4)
+        line_len = len(line.split())
+        draw_line(canvas, words[word_num:word_num + line_len], fonts, pen)
+        word_num += line_len
+        pen.coords['y'] += get_lineheight(pen.font)
 
 
 def generate_img(row:dict, include_credits:bool, pen:Pen) -> Image.Image:
@@ -337,6 +375,7 @@ def generate_img(row:dict, include_credits:bool, pen:Pen) -> Image.Image:
 
     # mode='L' constrains the image to 8-bit grayscale
     quote_image = Image.new(mode='L', size=(SCREEN_WIDTH, SCREEN_HEIGHT), color=BG_COLOR)
+    canvas = ImageDraw.Draw(quote_image)
 
     scale_multiplier = 0.99 # we don't want to write exactly to the edges
     quote_bbox = BoundingBox(
@@ -359,13 +398,13 @@ def generate_img(row:dict, include_credits:bool, pen:Pen) -> Image.Image:
 
         quote_credit = f'—{title.strip()}, {WordDelimiters.NEWLINE}{author.strip()}'
         pen.text = quote_credit
-        write_in_bbox(quote_image, pen)
+        write_in_bbox(canvas, pen)
         quote_bbox.bottom_right_y = int(pen.bbox.top_left_y * scale_multiplier) # resize to above credit bbox
 
     pen.bbox = quote_bbox
     pen.text = quote
     pen.text_type = TextType.QUOTE
-    write_in_bbox(quote_image, pen, timestring)
+    write_in_bbox(canvas, pen, timestring)
     pen.reset(pen.bbox.top_left_x, pen.bbox.top_left_y) # reset for the next img
 
     # Uncomment if images are being generated for a Kindle! The images need to be physically rotated
@@ -375,8 +414,214 @@ def generate_img(row:dict, include_credits:bool, pen:Pen) -> Image.Image:
     return quote_image
 
 
+def plan_images(quotereader, num_quotes:int,
+                image_format:str = IMAGE_FORMAT) -> list[tuple[dict, str]]:
+    '''Pair each row of the CSV file with the path of the image file that it is saved to.
+
+    Files are named after the row's time and its position among the rows for that minute, e.g.,
+    `images/quote_1235_2.bmp` for the third row for 12:35. Warnings for missing (or out-of-order)
+    minutes are printed here, in CSV order, so that they are the same no matter how the images are
+    rendered.
+
+    Args:
+        quotereader (csv.DictReader): The rows of the CSV file.
+        num_quotes (int): The number of rows to create images for.
+        image_format (str): The file extension to save images with (a Pillow format, or one of
+         the panel's frame formats from `frame_format.py`).
+
+    Returns:
+        tasks (list[tuple[dict, str]]): Each row, and the path to save its image to.
+    '''
+    tasks: list[tuple[dict, str]] = []
+    img_num = 0
+    previous_time = '00:00'
+    for i, curr_row in enumerate(quotereader):
+        if i >= num_quotes:
+            break
+
+        if curr_row['time'] == previous_time:
+            img_num += 1
+        else:
+            if not int(curr_row['time'][3:]) - 1 == int(previous_time[3:]) and previous_time[3:] != '59':
+                missing_min = int(previous_time[3:]) + 1
+                missing_min = f'0{str(missing_min)}' if missing_min <= 9 else str(missing_min)
+                missing_time = f'{previous_time[:2]}:{missing_min}'
+                print(f'Error: Missing or out-of-order quote for {missing_time}')
+            img_num = 0
+            previous_time = curr_row['time']
+
+        time = curr_row['time'].replace(':', '')
+        filepath = f'{IMAGE_PATH}quote_{time}_{img_num}.{image_format}' # e.g., images/quote_1235_2.bmp
+        tasks.append((curr_row, path.normpath(filepath)))
+    return tasks
+
+
+def render_settings_hash(image_format:str = IMAGE_FORMAT) -> str:
+    '''Hash every setting, other than a row's contents, that changes how its image looks.'''
+    settings = f'{layout_fingerprint()}|{BG_COLOR}|{QUOTE_COLOR}|{TIME_COLOR}|{CREDIT_COLOR}|' \
+               f'{INCLUDE_CREDITS}|{image_format}'
+    return hashlib.sha256(settings.encode('UTF-8')).hexdigest()
+
+
+def row_hash(row:dict, settings:str) -> str:
+    '''Hash the contents of a row, along with the settings hash that its image is rendered with.'''
+    contents = '|'.join([settings, row['time'], row['timestring'], row['quote'], row['title'],
+                         row['author']])
+    return hashlib.sha256(contents.encode('UTF-8')).hexdigest()
+
+
+def load_manifest(manifest_path:str) -> dict[str, str]:
+    '''Load the hash of each image file's row from the last time images were created.
+
+    Returns an empty manifest if there isn't one (or it can't be read), so every image is created.
+    '''
+    try:
+        with open(manifest_path, encoding='UTF-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest['images']
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        if path.exists(manifest_path):
+            logging.warning('Unable to read %s: %s', manifest_path, str(e))
+    return {}
+
+
+def save_manifest(manifest_path:str, images:dict[str, str]):
+    '''Save the hash of each image file's row, so that unchanged images are skipped next time.'''
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w', encoding='UTF-8') as manifest_file:
+        json.dump({'version': MANIFEST_VERSION, 'images': dict(sorted(images.items()))},
+                  manifest_file, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+_worker_pen: Optional[Pen] = None
+
+def _init_worker():
+    '''Give each worker process its own pen. (Fonts and layouts are cached per process.)'''
+    global _worker_pen # pylint: disable=global-statement
+    _worker_pen = Pen()
+
+
+def _save_img(task:tuple[dict, str]) -> str:
+    '''Generate the image for a row and save it to a file. Runs inside a worker process.'''
+    row, filepath = task
+    save_image(generate_img(row, INCLUDE_CREDITS, _worker_pen), filepath)
+    return filepath
+
+
+def _render_frame(task:tuple[dict, bool, str]) -> bytes:
+    '''Generate the image for a row and encode it into a frame. Runs inside a worker process.'''
+    row, include_credits, frame_format = task
+    return encode_frame(generate_img(row, include_credits, _worker_pen), frame_format)
+
+
+def _open_old_store(store_path:str, frame_format:str) -> Optional[FrameStore]:
+    '''Open the last frame store that was built, if its frames can be reused.'''
+    try:
+        old_store = FrameStore(store_path)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logging.warning('%s, rendering every frame.', str(e))
+        return None
+    if (old_store.width, old_store.height, old_store.frame_size) != \
+       (SCREEN_WIDTH, SCREEN_HEIGHT, frame_size(frame_format)):
+        old_store.close()
+        return None
+    return old_store
+
+
+def build_frame_store(store_path:str = FRAME_STORE_PATH, frame_format:str = EPD_1BPP,
+                      jobs:int = 1, force:bool = False) -> int:
+    '''Render every quote (and the startup screen) into a frame store (see `frame_store.py`).
+
+    The quotes are read the same way the clock reads them (see `quote_db.open_quotes()`). Frames
+    whose row and settings are unchanged since the last time the frame store was built are copied
+    from it rather than rendered again.
+
+    Args:
+        store_path (str): Where to write the frame store.
+        frame_format (str): The format to encode frames in, one of `frame_format.FRAME_FORMATS`.
+        jobs (int): The number of processes to render frames with.
+        force (bool): Render every frame, even if it is up to date.
+
+    Returns:
+        n_frames (int): The number of frames in the frame store.
+    '''
+    quotes = open_quotes()
+    if isinstance(quotes, QuoteDatabase):
+        sources = quotes.sources
+    else:
+        sources = [describe_source(quotes.path)]
+    slot_counts = [quotes.count(slot) for slot in range(MINUTES_PER_DAY)] + [1]
+    tasks = [(quotes.get_row(slot, n), INCLUDE_CREDITS, frame_format)
+             for slot in range(MINUTES_PER_DAY) for n in range(quotes.count(slot))]
+    tasks.append((STARTUP_ROW, False, frame_format))
+    quotes.close()
+
+    settings = render_settings_hash(frame_format)
+    hashes = [bytes.fromhex(row_hash(row, settings)) for row, _, _ in tasks]
+    old_store = None if force else _open_old_store(store_path, frame_format)
+    reusable = old_store.frames_by_hash() if old_store is not None else {}
+    to_render = [task for task, row_digest in zip(tasks, hashes) if row_digest not in reusable]
+    print(f'{len(tasks) - len(to_render)} frames are up to date.')
+
+    def frames(rendered:Iterator[bytes]) -> Iterator[bytes]:
+        done = 0
+        for row_digest in hashes:
+            if row_digest in reusable:
+                yield old_store.get_frame_at(reusable[row_digest])
+                continue
+            yield next(rendered)
+            done += 1
+            print(f'Rendering frames... {done}/{len(to_render)}', end='\r', flush=True)
+
+    try:
+        if jobs > 1:
+            chunksize = max(1, min(32, len(to_render) // (jobs * 4)))
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as executor:
+                rendered = executor.map(_render_frame, to_render, chunksize=chunksize)
+                n_frames = write_frame_store(store_path, frame_format, settings, slot_counts,
+                                             hashes, frames(rendered), sources)
+        else:
+            _init_worker()
+            n_frames = write_frame_store(store_path, frame_format, settings, slot_counts, hashes,
+                                         frames(map(_render_frame, to_render)), sources)
+    finally:
+        if old_store is not None:
+            old_store.close()
+    return n_frames
+
+
 if __name__ == "__main__":
-    my_pen = Pen()
+    parser = argparse.ArgumentParser(description=f'Save an image of each quote to {IMAGE_PATH}')
+    parser.add_argument('num_quotes', nargs='?', type=int,
+                        help='only create images for the first NUM_QUOTES rows')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to create images with (default: 1)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='recreate every image, even if it is up to date')
+    parser.add_argument('--format',
+                        help=f'file format to save images in (default: {IMAGE_FORMAT}); '
+                             f'{" or ".join(FRAME_FORMATS)} saves frames in the panel\'s native '
+                             'layout (see frame_format.py)')
+    parser.add_argument('--store', nargs='?', const=FRAME_STORE_PATH, metavar='PATH',
+                        help='render every quote into a single frame store that the clock '
+                             f'memory-maps (default: {FRAME_STORE_PATH}) instead of into image '
+                             'files; frames are in the screen\'s format unless --format is given')
+    args = parser.parse_args()
+
+    if args.store is not None:
+        store_format = args.format or (EPD_4GRAY if WAVESHARE_4GRAY else EPD_1BPP)
+        if store_format not in FRAME_FORMATS:
+            parser.error(f'--store needs a frame format ({" or ".join(FRAME_FORMATS)})')
+        if args.num_quotes is not None:
+            parser.error('--store renders every quote')
+        n_store_frames = build_frame_store(args.store, store_format, args.jobs, args.force)
+        print(f'Saved {n_store_frames} {store_format} frames to {args.store}.\r\n')
+        sys.exit(0)
+    args.format = args.format or IMAGE_FORMAT
 
     try:
         if not path.exists(IMAGE_PATH):
@@ -389,35 +634,46 @@ if __name__ == "__main__":
         num_quotes = len(csvfile.readlines()) - 1
         csvfile.seek(0) # move file cursor to start of file
 
-        if len(argv) > 1:
-            if argv[1].isdigit() and int(argv[1]) < num_quotes:
-                num_quotes = int(argv[1])
+        full_run = True
+        if args.num_quotes is not None and 0 <= args.num_quotes < num_quotes:
+            num_quotes = args.num_quotes
+            full_run = False
 
         quotereader = csv.DictReader(csvfile, delimiter='|')
-        img_num = 0
-        previous_time = '00:00'
-        quote_img:Image.Image
-        for i, curr_row in enumerate(quotereader):
-            if i >= num_quotes:
-                break
-
-            if curr_row['time'] == previous_time:
-                img_num += 1
-            else:
-                if not int(curr_row['time'][3:]) - 1 == int(previous_time[3:]) and previous_time[3:] != '59':
-                    missing_min = int(previous_time[3:]) + 1
-                    missing_min = f'0{str(missing_min)}' if missing_min <= 9 else str(missing_min)
-                    missing_time = f'{previous_time[:2]}:{missing_min}'
-                    print(f'Error: Missing or out-of-order quote for {missing_time}')
-                img_num = 0
-                previous_time = curr_row['time']
-
-            time = curr_row['time'].replace(':', '')
-            filepath = f'{IMAGE_PATH}quote_{time}_{img_num}.{IMAGE_FORMAT}' # e.g., images/quote_1235_2.bmp
-            filepath = path.normpath(filepath)
-
-            quote_img = generate_img(curr_row, INCLUDE_CREDITS, my_pen)
-            quote_img.save(filepath)
-            progressbar = f'Creating images... {i+1}/{num_quotes}'
+        images = plan_images(quotereader, num_quotes, args.format)
+
+    # Only create the images whose row (or the settings they are rendered with) has changed.
+    manifest_path = path.join(IMAGE_PATH, MANIFEST_NAME)
+    old_manifest = {} if args.force else load_manifest(manifest_path)
+    settings = render_settings_hash(args.format)
+    row_hashes = {filepath: row_hash(row, settings) for row, filepath in images}
+    images = [(row, filepath) for row, filepath in images
+              if old_manifest.get(filepath) != row_hashes[filepath] or not path.exists(filepath)]
+    print(f'{len(row_hashes) - len(images)} images are up to date.')
+
+    if args.jobs > 1:
+        # Rows are handed out in chunks so that each worker keeps reusing its own fonts and pen.
+        chunksize = max(1, min(32, len(images) // (args.jobs * 4)))
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker) as executor:
+            for i, _ in enumerate(executor.map(_save_img, images, chunksize=chunksize)):
+                progressbar = f'Creating images... {i+1}/{len(images)}'
+                print(progressbar, end='\r', flush=True)
+    elif images:
+        _init_worker()
+        for i, image in enumerate(images):
+            _save_img(image)
+            progressbar = f'Creating images... {i+1}/{len(images)}'
             print(progressbar, end='\r', flush=True)
+        logging.info('%r', font_registry)
+
+    if full_run:
+        # delete the images for rows that no longer exist (images in other formats are kept)
+        orphans = set(old_manifest) | set(glob(path.join(IMAGE_PATH, f'quote_*.{args.format}')))
+        for orphan in orphans - set(row_hashes):
+            if orphan.endswith(f'.{args.format}') and path.exists(orphan):
+                os.remove(orphan)
+                print(f'Deleted {orphan}')
+        save_manifest(manifest_path, row_hashes)
+    else:
+        save_manifest(manifest_path, {**old_manifest, **row_hashes})
     print('Image generation complete.\r\n')
@@ -0,0 +1,182 @@
+'''A persistent cache of the font size and line wrapping found for each piece of text.
+
+Finding the optimal font size for a quote takes about 7-8 full passes of wrapping its text, and the
+result is the same every time that quote comes around again. The result only depends on the text,
+the bbox it is written in, whether it is a quote or credits, the font files, and the screen/text
+constants, so it is stored in a small SQLite database and looked up before searching.
+
+- Entries are keyed by a hash of the text, bbox, and text type.
+- The font files and constants are hashed into a fingerprint that is stored alongside the entries.
+  If the fingerprint changes (e.g., a font file is replaced or `SCREEN_WIDTH` is changed), every
+  entry is thrown out.
+- The cache holds at most `LAYOUT_CACHE_SIZE` entries; the least recently used ones are evicted.
+  Lookups only note an entry's recency in memory, and it is written to the database in batches
+  (or when a layout is stored), so a cache hit doesn't write to the SD card.
+'''
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+from constants import SCREEN_WIDTH, SCREEN_HEIGHT, MIN_FONT_SIZE, MAX_FONT_SIZE
+from constants import LAYOUT_CACHE_PATH, LAYOUT_CACHE_SIZE
+from writer import BoundingBox, FontPath, TextType
+
+# Bump this whenever a change to the layout code would change the size or wrapping of any text.
+LAYOUT_VERSION = 2
+RECENCY_BATCH = 256 # cache hits to note in memory before their recency is written to the database
+
+
+def layout_fingerprint() -> str:
+    '''Hash everything, other than the text itself, that a layout depends on.'''
+    digest = hashlib.sha256(f'{LAYOUT_VERSION}|{SCREEN_WIDTH}|{SCREEN_HEIGHT}|{MIN_FONT_SIZE}|'
+                            f'{MAX_FONT_SIZE}'.encode('UTF-8'))
+    for font_path in (FontPath.REGULAR, FontPath.BOLD, FontPath.ITALIC, FontPath.ITALIC_BOLD,
+                      FontPath.CREDIT):
+        with open(font_path, 'rb') as font_file:
+            digest.update(font_file.read())
+    return digest.hexdigest()
+
+
+class LayoutCache:
+    '''Stores the result of `find_optimal_font_size()` on disk.
+
+    Attributes:
+        path (str): The path to the SQLite database.
+        max_entries (int): The maximum number of layouts to keep.
+        hits (int): The number of lookups that found a layout.
+        misses (int): The number of lookups that did not find a layout.
+    '''
+    def __init__(self, path:str, max_entries:int = LAYOUT_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._recent: dict[str, int] = {} # the tick that each entry was last used at, not yet saved
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS layouts (
+                key TEXT PRIMARY KEY,
+                font_size INTEGER,
+                lines TEXT,
+                bbox TEXT,
+                last_used INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS layouts_last_used ON layouts (last_used);
+        ''')
+
+        fingerprint = layout_fingerprint()
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            if row is not None:
+                logging.info('Fonts or constants have changed. Clearing layout cache.')
+            with self._db:
+                self._db.execute('DELETE FROM layouts')
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)",
+                                 (fingerprint,))
+
+        # A counter is used instead of a timestamp because the Pi's clock can jump on startup.
+        self._tick = self._db.execute('SELECT COALESCE(MAX(last_used), 0) FROM layouts').fetchone()[0]
+        self._size = self._db.execute('SELECT COUNT(*) FROM layouts').fetchone()[0]
+
+    @staticmethod
+    def key(text:str, bbox:BoundingBox, text_type:TextType) -> str:
+        '''Hash the inputs of a layout into a cache key. Must be called before the bbox is resized.'''
+        return hashlib.sha256(f'{text_type.name}|{bbox!r}|{text}'.encode('UTF-8')).hexdigest()
+
+    def get(self, key:str) -> Optional[tuple[int, str, tuple[int, int, int, int]]]:
+        '''Look up a layout.
+
+        Returns:
+            layout (tuple | None): The optimal font size, the wrapped lines, and the bbox's
+            coordinates after it was resized, or `None` if the layout isn't cached.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT font_size, lines, bbox FROM layouts WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._tick += 1
+            self._recent[key] = self._tick
+            if len(self._recent) >= RECENCY_BATCH:
+                try:
+                    with self._db:
+                        self._save_recency()
+                except sqlite3.OperationalError:
+                    pass # another process is writing to the cache; try again with the next batch
+        font_size, lines, bbox = row
+        return (font_size, lines, tuple(int(coord) for coord in bbox.split(',')))
+
+    def _save_recency(self):
+        '''Write the recency of the entries that were used since the last write. The caller holds
+        the lock and commits.'''
+        if self._recent:
+            self._db.executemany('UPDATE layouts SET last_used = ? WHERE key = ?',
+                                 [(tick, key) for key, tick in self._recent.items()])
+            self._recent.clear()
+
+    def put(self, key:str, font_size:int, lines:str, bbox:BoundingBox):
+        '''Store a layout, evicting the least recently used layouts if the cache is full.'''
+        coords = f'{bbox.top_left_x},{bbox.top_left_y},{bbox.bottom_right_x},{bbox.bottom_right_y}'
+        try:
+            with self._lock, self._db:
+                self._save_recency() # so that recently used entries aren't evicted
+                self._tick += 1
+                inserted = self._db.execute(
+                    'INSERT OR IGNORE INTO layouts VALUES (?, ?, ?, ?, ?)',
+                    (key, font_size, lines, coords, self._tick)).rowcount
+                self._size += inserted
+                if self._size > self.max_entries:
+                    self._db.execute('DELETE FROM layouts WHERE key IN (SELECT key FROM layouts '
+                                     'ORDER BY last_used LIMIT ?)', (self._size - self.max_entries,))
+                    self._size = self.max_entries
+        except sqlite3.OperationalError as e:
+            # e.g., another process is writing to the cache; the layout is just recomputed next time
+            logging.warning('Unable to cache layout: %s', str(e))
+
+    def clear(self):
+        '''Remove every layout from the cache.'''
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM layouts')
+            self._recent.clear()
+            self._size = 0
+
+    def close(self):
+        '''Save the recency of recently used entries, then close the SQLite database.'''
+        with self._lock:
+            try:
+                with self._db:
+                    self._save_recency()
+            except sqlite3.OperationalError:
+                pass
+            self._db.close()
+
+
+_cache: Optional[LayoutCache] = None
+_cache_pid = 0
+
+def get_layout_cache() -> Optional[LayoutCache]:
+    '''Return this process's layout cache, opening it on first use.
+
+    Returns `None` if `LAYOUT_CACHE_PATH` is not set, or if the cache can't be opened (the layout
+    is then just computed every time).
+    '''
+    global _cache, _cache_pid # pylint: disable=global-statement
+    if not LAYOUT_CACHE_PATH:
+        return None
+    if _cache_pid != os.getpid(): # SQLite connections can't be shared by forked processes
+        _cache_pid = os.getpid()
+        try:
+            _cache = LayoutCache(LAYOUT_CACHE_PATH)
+        except (sqlite3.Error, OSError) as e:
+            logging.error('Unable to open layout cache %s: %s', LAYOUT_CACHE_PATH, str(e))
+            _cache = None
+    return _cache
@@ -0,0 +1,113 @@
+'''Microbenchmarks for the Waveshare driver's image conversion.
+
+Compares the driver's current conversion against the original per-byte Python loop, and checks that
+both produce the same bytes. The busy wait is timed with gpiozero's mock pins, so no screen has to
+be connected. Run it from the repo's root directory on the Pi:
+
+```sh
+python3 misc/benchmark_epd.py
+```
+'''
+import argparse
+import os
+import sys
+import threading
+import time
+import timeit
+
+from PIL import Image, ImageDraw
+
+os.environ.setdefault('GPIOZERO_PIN_FACTORY', 'mock') # must be set before the driver is imported
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from waveshare_libraries import epd7in5_V2 # pylint: disable=wrong-import-position
+
+
+def legacy_getbuffer(epd:epd7in5_V2.EPD, image:Image.Image) -> bytearray:
+    '''`EPD.getbuffer()` as Waveshare wrote it, inverting one byte at a time.'''
+    img = image
+    if image.size == (epd.width, epd.height):
+        img = img.convert('1')
+    else:
+        img = img.rotate(90, expand=True).convert('1')
+    buf = bytearray(img.tobytes('raw'))
+    for i in range(len(buf)):
+        buf[i] ^= 0xFF
+    return buf
+
+
+def legacy_old_data(epd:epd7in5_V2.EPD, image:bytes) -> list[int]:
+    '''The old data that `EPD.display()` built for the panel, as Waveshare wrote it.'''
+    width = epd.width // 8
+    image1 = [0xFF] * int(epd.width * epd.height / 8)
+    for j in range(epd.height):
+        for i in range(width):
+            image1[i + j * width] = ~image[i + j * width]
+    return image1
+
+
+def legacy_read_busy(epd:epd7in5_V2.EPD):
+    '''`EPD.ReadBusy()` as Waveshare wrote it, spinning on the BUSY pin.'''
+    epd.send_command(0x71)
+    busy = epd7in5_V2.epdconfig.digital_read(epd.busy_pin)
+    while busy == 0:
+        epd.send_command(0x71)
+        busy = epd7in5_V2.epdconfig.digital_read(epd.busy_pin)
+    epd7in5_V2.epdconfig.delay_ms(20)
+
+
+def bench_busy(name:str, func, busy_seconds:float):
+    '''Hold the mock BUSY pin low for `busy_seconds`, and time how long (and how much CPU) it takes
+    for a busy wait to notice that it went high.'''
+    pin = epd7in5_V2.epdconfig.GPIO_BUSY_PIN.pin
+    pin.drive_low()
+    timer = threading.Timer(busy_seconds, pin.drive_high)
+    start, cpu_start = time.perf_counter(), time.process_time()
+    timer.start()
+    func()
+    wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    print(f'{name:<32} {(wall - busy_seconds) * 1000:8.3f} ms late, {cpu * 1000:8.1f} ms of CPU')
+
+
+def sample_image(width:int, height:int) -> Image.Image:
+    '''Draw an image with black, grey, and antialiased text, like a quote.'''
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    for y in range(0, height - 20, 24):
+        draw.text((10, y), 'The clock struck twelve, and all was quiet. ' * 3,
+                  fill=0 if y % 48 else 128)
+    return image
+
+
+def bench(name:str, func, number:int, baseline:float = 0.0) -> float:
+    '''Time a function and print its average time per call (and speedup over `baseline`).'''
+    seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+    speedup = f' ({baseline / seconds:.1f}x faster)' if baseline else ''
+    print(f'{name:<32} {seconds * 1000:8.3f} ms{speedup}')
+    return seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Waveshare driver.')
+    parser.add_argument('-n', '--number', type=int, default=20, help='calls per timing')
+    parser.add_argument('--busy', type=float, default=2.0,
+                        help='seconds that the mock screen stays busy for')
+    args = parser.parse_args()
+
+    epd = epd7in5_V2.EPD()
+    landscape = sample_image(epd.width, epd.height)
+    portrait = landscape.rotate(-90, expand=True)
+
+    for label, img in (('getbuffer', landscape), ('getbuffer (rotated)', portrait)):
+        assert bytes(legacy_getbuffer(epd, img)) == bytes(epd.getbuffer(img))
+        legacy = bench(f'{label}, legacy', lambda: legacy_getbuffer(epd, img), args.number)
+        bench(label, lambda: epd.getbuffer(img), args.number, legacy)
+
+    frame = epd.getbuffer(landscape)
+    assert bytes(value & 0xFF for value in legacy_old_data(epd, frame)) == bytes(epd.invert(frame))
+    legacy = bench('display old data, legacy', lambda: legacy_old_data(epd, frame), args.number)
+    bench('display old data', lambda: epd.invert(frame), args.number, legacy)
+
+    if os.environ['GPIOZERO_PIN_FACTORY'] == 'mock':
+        epd7in5_V2.epdconfig.spi_writebyte = lambda data: None # the SPI bus isn't opened
+        bench_busy('ReadBusy, legacy', lambda: legacy_read_busy(epd), args.busy)
+        bench_busy('ReadBusy', epd.ReadBusy, args.busy)
@@ -0,0 +1,113 @@
+'''Run the clock against a simulated Waveshare screen, without a Pi.
+
+The mock backend (see `MockPi` in `waveshare_libraries/epdconfig.py`) records every command and
+byte that the driver sends, holds the BUSY pin low for about as long as the real screen would, and
+rebuilds the image that the screen would show. This script runs `Clock.main()` for a number of
+minutes back to back (without sleeping until each minute), checks that the screen shows each quote,
+and reports the time and SPI traffic of each step. Run it from the repo's root directory:
+
+```sh
+python3 misc/simulate_clock.py --minutes 10
+python3 misc/simulate_clock.py --minutes 3 --time-scale 1 --save sim/ # wait as long as the screen
+```
+'''
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SkipAheadTime:
+    '''Wall and monotonic clocks that run in real time, but skip ahead instead of sleeping.'''
+    def __init__(self):
+        self.skipped = 0.0
+
+    def time(self) -> float:
+        '''Return the simulated wall clock time.'''
+        return time.time() + self.skipped
+
+    def monotonic(self) -> float:
+        '''Return the simulated monotonic clock time.'''
+        return time.monotonic() + self.skipped
+
+    def sleep(self, seconds:float):
+        '''Skip ahead by `seconds`.'''
+        self.skipped += seconds
+
+
+def report(epd, panel, spi):
+    '''Print the totals for each of the driver's methods and for the simulated screen.'''
+    print(f'\n{"method":<16}{"calls":>6}{"bytes":>10}{"transfers":>11}{"SPI ms":>9}'
+          f'{"busy ms":>10}{"total ms":>10}')
+    for name, stats in sorted(epd.stats.items()):
+        print(f'{name:<16}{stats["calls"]:>6}{stats["bytes"]:>10}{stats["transfers"]:>11}'
+              f'{stats["spi_time"] * 1000:>9.1f}{stats["busy_time"] * 1000:>10.1f}'
+              f'{stats["wall_time"] * 1000:>10.1f}')
+    print(f'\nrefreshes: {panel.refresh_counts}')
+    print(f'commands: {sum(panel.command_counts.values())}, data bytes: {panel.data_bytes}, '
+          f'time on the wire at {spi.max_speed_hz / 1e6:g} MHz: {spi.bus_time * 1000:.1f} ms, '
+          f'time busy: {panel.busy_time:.1f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the clock against a simulated screen.')
+    parser.add_argument('-m', '--minutes', type=int, default=5, help='minutes to run for')
+    parser.add_argument('--time-scale', type=float, default=0.0,
+                        help='how long the screen is busy for, relative to a real one (default: 0)')
+    parser.add_argument('--save', metavar='DIR', help='save what the screen shows after each minute')
+    args = parser.parse_args()
+
+    # the backend is picked when the driver is imported
+    os.environ['EPD_BACKEND'] = 'mock'
+    os.environ['EPD_MOCK_TIME_SCALE'] = str(args.time_scale)
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    import clock # pylint: disable=import-error,wrong-import-position
+    # pylint: disable-next=wrong-import-position
+    from constants import SCREEN_TYPE, ScreenOptions, WAVESHARE_4GRAY
+    from scheduler import MinuteScheduler # pylint: disable=wrong-import-position
+    from waveshare_libraries import epd7in5_V2 # pylint: disable=wrong-import-position
+
+    if SCREEN_TYPE != ScreenOptions.WAVESHARE:
+        sys.exit('The simulated screen is a Waveshare screen; set SCREEN_TYPE to WAVESHARE.')
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+
+    sim = clock.Clock()
+    clock_time = SkipAheadTime() # don't wait for each minute
+    sim.scheduler = MinuteScheduler(wall=clock_time.time, monotonic=clock_time.monotonic,
+                                    sleep=clock_time.sleep)
+    epd, panel, spi = sim.screen.epd, epd7in5_V2.epdconfig.panel, epd7in5_V2.epdconfig.SPI
+    if sim.store is None:
+        sim.cache_quotes()
+    sim.wipe_screen()
+    now = clock.datetime.now().replace(second=0, microsecond=0)
+    sim.producer.start(now)
+    sim.display_quote(now, wait=30)
+    sim.screen.sleep()
+
+    mismatches = 0
+    for minute in range(args.minutes):
+        start = time.perf_counter()
+        sim.main()
+        elapsed = time.perf_counter() - start
+        shown = panel.image()
+        if WAVESHARE_4GRAY:
+            matches = epd.getbuffer_4Gray(shown) == sim.current_frame
+        else:
+            matches = bytes(epd.getbuffer(shown)) == sim.current_frame
+        mismatches += not matches
+        print(f'minute {minute + 1} ({sim.scheduler.last_minute:%H:%M}): {elapsed * 1000:7.1f} ms,'
+              f' screen {"matches" if matches else "DOES NOT match"} the quote')
+        if args.save:
+            shown.save(os.path.join(args.save, f'minute_{minute + 1}.png'))
+
+    report(epd, panel, spi)
+    print(f'lead time: {sim.scheduler.lead_time * 1000:.1f} ms, missed minutes: '
+          f'{sim.scheduler.missed_minutes}, clock jumps: {sim.scheduler.clock_jumps}')
+    frames = sim.producer.frames
+    print(f'quotes rendered: {sim.producer.rendered}, buffer hits: {frames.hits}, misses: '
+          f'{frames.misses}, thrown away: {frames.evicted}, fallbacks: {sim.fallbacks}')
+    sys.exit(1 if mismatches else 0)
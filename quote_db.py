@@ -0,0 +1,302 @@
+'''Compile the quote CSV file(s) into a binary database that can be loaded without any parsing.
+
+Parsing the CSV file on every boot is wasted work, because the quotes only change when the CSV file
+is edited. Instead, the CSV file(s) can be compiled once:
+
+```sh
+python3 quote_db.py compile                # quotes.csv -> quotes.bin
+python3 quote_db.py compile --include-mine # also merge in misc/my-quotes.csv
+```
+
+The clock then memory-maps the compiled file and reads rows straight out of it. If the compiled file
+is missing, or if any of the CSV files it was compiled from have changed since, the clock falls back
+to indexing the CSV file (see `quote_index.py`).
+
+File layout (all integers are little-endian and unsigned unless noted):
+```
+header   magic 'LQDB', version (u16), n_sources (u16), n_rows, n_strings, and the byte offset of
+         each of the sections below (u32)
+sources  per source: path length (u16), UTF-8 path, mtime_ns (i64), size (u64), SHA-256 (32 bytes)
+slots    1440 x (first row, row count)             -- one entry per minute of the day
+rows     n_rows x (timestring, quote, title, author) -- ids into the string table
+strings  n_strings x (offset, length)              -- byte ranges in the blob; each string is stored
+                                                     once, so titles and authors are shared
+blob     the UTF-8 text of every string
+```
+'''
+import argparse
+from array import array
+import csv
+import hashlib
+import io
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from constants import QUOTES_PATH, QUOTES_DB_PATH, MY_QUOTES_PATH
+from quote_index import QuoteIndex, MINUTES_PER_DAY, minute_of_day
+
+MAGIC = b'LQDB'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIIIIII')
+SOURCE = struct.Struct('<qQ32s')
+ROW_FIELDS = ('timestring', 'quote', 'title', 'author')
+
+
+def _hash_file(path:str) -> bytes:
+    '''Return the SHA-256 digest of a file's contents.'''
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).digest()
+
+
+def describe_source(path:str) -> tuple:
+    '''Return `(path, mtime_ns, size, sha256)` for a file that something is built from.'''
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size, _hash_file(path))
+
+
+def pack_sources(sources:list[tuple]) -> bytes:
+    '''Pack the `(path, mtime_ns, size, sha256)` of each source into a sources section.'''
+    section = bytearray()
+    for path, mtime_ns, size, digest in sources:
+        encoded_path = path.encode('UTF-8')
+        section += struct.pack('<H', len(encoded_path)) + encoded_path
+        section += SOURCE.pack(mtime_ns, size, digest)
+    return bytes(section)
+
+
+def unpack_sources(buffer, offset:int, n_sources:int) -> list[tuple]:
+    '''Read the `(path, mtime_ns, size, sha256)` of each source out of a sources section.'''
+    sources = []
+    for _ in range(n_sources):
+        (path_len,) = struct.unpack_from('<H', buffer, offset)
+        path = bytes(buffer[offset + 2:offset + 2 + path_len]).decode('UTF-8')
+        offset += 2 + path_len
+        sources.append((path, *SOURCE.unpack_from(buffer, offset)))
+        offset += SOURCE.size
+    return sources
+
+
+def sources_changed(sources:list[tuple]) -> bool:
+    '''Check if any of the files that something was built from have changed.
+
+    A source whose modification time and size are unchanged is assumed to be unchanged. Otherwise,
+    its contents are hashed and compared, so a file that was only touched (or copied) does not count
+    as changed.
+    '''
+    for path, mtime_ns, size, digest in sources:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return True
+        if stat.st_mtime_ns == mtime_ns and stat.st_size == size:
+            continue
+        if _hash_file(path) != digest:
+            return True
+    return False
+
+
+def compile_quotes(sources:list[str], out_path:str) -> int:
+    '''Compile one or more quote CSV files into a binary database.
+
+    Rows from every source are merged by minute, in the order that the sources are given. A row that
+    is an exact duplicate of one from an earlier source (e.g., a quote in `my-quotes.csv` that is
+    also in `quotes.csv`) is skipped.
+
+    Args:
+        sources (list[str]): Paths to the CSV files to compile.
+        out_path (str): Where to write the compiled database.
+
+    Returns:
+        n_rows (int): The number of rows in the compiled database.
+    '''
+    slots: list[list[tuple]] = [[] for _ in range(MINUTES_PER_DAY)]
+    seen: set[tuple] = set() # (slot, fields) of the rows from earlier sources
+    source_info = []
+    for path in sources:
+        stat = os.stat(path)
+        with open(path, 'rb') as file:
+            data = file.read()
+        source_info.append((path, stat.st_mtime_ns, stat.st_size, hashlib.sha256(data).digest()))
+
+        added = set()
+        reader = csv.DictReader(io.StringIO(data.decode('UTF-8'), newline=''), delimiter='|')
+        for row in reader:
+            slot = minute_of_day(int(row['time'][:2]), int(row['time'][3:]))
+            fields = tuple(row[field] for field in ROW_FIELDS)
+            if (slot, fields) not in seen:
+                slots[slot].append(fields)
+                added.add((slot, fields))
+        seen |= added
+
+    string_ids: dict[str, int] = {}
+    string_table = array('I')
+    blob = bytearray()
+    slot_table = array('I')
+    row_table = array('I')
+    for rows in slots:
+        slot_table.extend((len(row_table) // len(ROW_FIELDS), len(rows)))
+        for fields in rows:
+            for text in fields:
+                if text not in string_ids:
+                    encoded = text.encode('UTF-8')
+                    string_ids[text] = len(string_ids)
+                    string_table.extend((len(blob), len(encoded)))
+                    blob += encoded
+                row_table.append(string_ids[text])
+    if sys.byteorder != 'little':
+        for table in (slot_table, row_table, string_table):
+            table.byteswap()
+
+    source_section = pack_sources(source_info)
+
+    sources_off = HEADER.size
+    slots_off = sources_off + len(source_section)
+    slots_off += -slots_off % 4 # keep the tables aligned so they can be cast without copying
+    rows_off = slots_off + len(slot_table) * 4
+    strings_off = rows_off + len(row_table) * 4
+    blob_off = strings_off + len(string_table) * 4
+    n_rows = len(row_table) // len(ROW_FIELDS)
+
+    tmp_path = f'{out_path}.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, VERSION, len(source_info), n_rows, len(string_ids),
+                              sources_off, slots_off, rows_off, strings_off, blob_off))
+        out.write(source_section)
+        out.write(bytes(slots_off - sources_off - len(source_section)))
+        out.write(slot_table.tobytes())
+        out.write(row_table.tobytes())
+        out.write(string_table.tobytes())
+        out.write(blob)
+    os.replace(tmp_path, out_path) # a half-written database is never loaded
+    return n_rows
+
+
+class QuoteDatabase:
+    '''A compiled quote database, memory-mapped and read in place.
+
+    It has the same interface as `QuoteIndex`, so the clock can use either one.
+
+    Attributes:
+        path (str): The path to the compiled database.
+        sources (list[tuple]): `(path, mtime_ns, size, sha256)` for each CSV file the database was
+         compiled from.
+
+    Raises:
+        ValueError: The file is not a quote database, or it was written by a different version.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as dbfile:
+            self._mmap = mmap.mmap(dbfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, n_sources, self._n_rows, n_strings, sources_off, slots_off, rows_off,
+             strings_off, self._blob_off) = HEADER.unpack_from(self._mmap, 0)
+        except struct.error as e:
+            self._mmap.close()
+            raise ValueError(f'{path} is not a quote database') from e
+        if magic != MAGIC or version != VERSION or sys.byteorder != 'little':
+            self._mmap.close()
+            raise ValueError(f'{path} is not a version {VERSION} quote database')
+
+        self.sources = unpack_sources(self._mmap, sources_off, n_sources)
+
+        self._view = memoryview(self._mmap)
+        self._slots = self._view[slots_off:rows_off].cast('I')
+        self._rows = self._view[rows_off:strings_off].cast('I')
+        self._strings = self._view[strings_off:strings_off + n_strings * 8].cast('I')
+
+    def is_stale(self) -> bool:
+        '''Check if any of the CSV files the database was compiled from have changed (see
+        `sources_changed()`).'''
+        return sources_changed(self.sources)
+
+    def __len__(self) -> int:
+        return self._n_rows
+
+    def count(self, slot:int) -> int:
+        '''Return the number of rows for a minute of the day.'''
+        return self._slots[2 * slot + 1]
+
+    def _string(self, string_id:int) -> str:
+        offset = self._blob_off + self._strings[2 * string_id]
+        return self._mmap[offset:offset + self._strings[2 * string_id + 1]].decode('UTF-8')
+
+    def get_row(self, slot:int, n:int) -> dict:
+        '''Read a single row from the database.
+
+        Args:
+            slot (int): The minute of the day (0-1439) to get a row for.
+            n (int): Which of the minute's rows to get.
+
+        Returns:
+            row (dict): The row, keyed by the same column names as the CSV file.
+
+        Raises:
+            IndexError: The minute does not have an `n`th row.
+        '''
+        if not 0 <= n < self._slots[2 * slot + 1]:
+            raise IndexError(f'minute {slot} has no row {n}')
+        base = (self._slots[2 * slot] + n) * len(ROW_FIELDS)
+        row = {'time': f'{slot // 60:02}:{slot % 60:02}'}
+        for i, field in enumerate(ROW_FIELDS):
+            row[field] = self._string(self._rows[base + i])
+        return row
+
+    def close(self):
+        '''Unmap the database.'''
+        for view in (self._slots, self._rows, self._strings, self._view):
+            view.release()
+        self._mmap.close()
+
+
+def open_quotes(db_path:str = QUOTES_DB_PATH, csv_path:str = QUOTES_PATH):
+    '''Open the compiled quote database, or index the CSV file if the database can't be used.
+
+    Args:
+        db_path (str): The path to the compiled database.
+        csv_path (str): The CSV file to fall back to.
+
+    Returns:
+        quotes (QuoteDatabase | QuoteIndex): The quotes, looked up by minute of the day.
+
+    Raises:
+        FileNotFoundError: Neither the database nor the CSV file could be opened.
+    '''
+    try:
+        database = QuoteDatabase(db_path)
+    except FileNotFoundError:
+        logging.info('%s not found, indexing %s instead.', db_path, csv_path)
+        return QuoteIndex(csv_path)
+    except ValueError as e:
+        logging.warning('%s, indexing %s instead.', str(e), csv_path)
+        return QuoteIndex(csv_path)
+
+    if database.is_stale():
+        logging.warning('%s is out of date (run `python3 quote_db.py compile`), indexing %s '
+                        'instead.', db_path, csv_path)
+        database.close()
+        return QuoteIndex(csv_path)
+    return database
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the binary quote database.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    compile_parser = commands.add_parser('compile', help='compile CSV file(s) into a database')
+    compile_parser.add_argument('sources', nargs='*', default=[QUOTES_PATH],
+                                help=f'CSV files to compile (default: {QUOTES_PATH})')
+    compile_parser.add_argument('--include-mine', action='store_true',
+                                help=f'also compile {MY_QUOTES_PATH}')
+    compile_parser.add_argument('-o', '--output', default=QUOTES_DB_PATH,
+                                help=f'where to write the database (default: {QUOTES_DB_PATH})')
+    args = parser.parse_args()
+
+    if args.command == 'compile':
+        csv_paths = list(args.sources)
+        if args.include_mine and MY_QUOTES_PATH not in csv_paths:
+            csv_paths.append(MY_QUOTES_PATH)
+        num_rows = compile_quotes(csv_paths, args.output)
+        print(f'Compiled {num_rows} quotes from {", ".join(csv_paths)} into {args.output}')
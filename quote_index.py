@@ -0,0 +1,116 @@
+'''A compact, memory-mapped index of the rows in the quote CSV file.
+
+Keeping every row of the CSV file as a `dict` costs several megabytes of RAM for the entire life of
+the clock, which is most of the spare memory on a Pi Zero. Instead, the CSV file is memory-mapped
+and only the byte offset of each row is stored. Rows are then decoded one at a time, when they are
+actually needed.
+
+Example structure:
+```Python
+slot_starts  = [0, 4, 6, ...]        # index into row_offsets where each minute's rows begin
+slot_counts  = [4, 2, 3, ...]        # number of rows for each minute
+row_offsets  = [34, 221, 436, ...]   # byte offset of each row in the CSV file
+```
+'''
+from array import array
+import csv
+import mmap
+
+MINUTES_PER_DAY = 1440
+
+
+def minute_of_day(hour:int, minute:int) -> int:
+    '''Convert an hour and minute into the number of minutes since midnight.'''
+    return hour * 60 + minute
+
+
+class QuoteIndex:
+    '''Maps each minute of the day to the rows in the quote CSV file that can be displayed for it.
+
+    Attributes:
+        path (str): The path to the CSV file that is indexed.
+        fieldnames (list[str]): The column names from the CSV file's header row.
+        row_offsets (array): The byte offset of every row in the CSV file, grouped by minute.
+        slot_starts (array): For each minute of the day, the index in `row_offsets` where the
+         minute's rows begin.
+        slot_counts (array): For each minute of the day, the number of rows that it has.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as quotefile:
+            # the mapping stays valid after the file is closed
+            self._mmap = mmap.mmap(quotefile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fieldnames: list[str] = []
+        self.row_offsets = array('I')
+        self.slot_starts = array('I', bytes(4 * MINUTES_PER_DAY))
+        self.slot_counts = array('H', bytes(2 * MINUTES_PER_DAY))
+        self._build()
+
+    def _build(self):
+        '''Scan the memory-mapped file once and record where each minute's rows are.'''
+        data = self._mmap
+        header_end = data.find(b'\n')
+        if header_end == -1:
+            header_end = len(data)
+        header = data[:header_end].decode('UTF-8').rstrip('\r')
+        self.fieldnames = next(csv.reader((header,), delimiter='|'))
+
+        offsets = array('I')
+        minutes = array('H')
+        pos = header_end + 1
+        while pos < len(data):
+            end = data.find(b'\n', pos)
+            if end == -1:
+                end = len(data)
+            if end - pos >= 5: # skip blank lines
+                # rows start with their time as 'HH:MM'; 48 is the ASCII value of '0'
+                hour = (data[pos] - 48) * 10 + data[pos + 1] - 48
+                minute = (data[pos + 3] - 48) * 10 + data[pos + 4] - 48
+                offsets.append(pos)
+                minutes.append(minute_of_day(hour, minute))
+            pos = end + 1
+
+        # the CSV file should already be in order, but don't rely on it
+        if any(minutes[i] > minutes[i + 1] for i in range(len(minutes) - 1)):
+            order = sorted(range(len(minutes)), key=minutes.__getitem__)
+            offsets = array('I', (offsets[i] for i in order))
+            minutes = array('H', (minutes[i] for i in order))
+
+        for i, slot in enumerate(minutes):
+            if self.slot_counts[slot] == 0:
+                self.slot_starts[slot] = i
+            self.slot_counts[slot] += 1
+        self.row_offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.row_offsets)
+
+    def count(self, slot:int) -> int:
+        '''Return the number of rows for a minute of the day.'''
+        return self.slot_counts[slot]
+
+    def get_row(self, slot:int, n:int) -> dict:
+        '''Decode a single row from the CSV file.
+
+        Args:
+            slot (int): The minute of the day (0-1439) to get a row for.
+            n (int): Which of the minute's rows to get.
+
+        Returns:
+            row (dict): The row, keyed by the CSV file's column names.
+
+        Raises:
+            IndexError: The minute does not have an `n`th row.
+        '''
+        if not 0 <= n < self.slot_counts[slot]:
+            raise IndexError(f'minute {slot} has no row {n}')
+        start = self.row_offsets[self.slot_starts[slot] + n]
+        end = self._mmap.find(b'\n', start)
+        if end == -1:
+            end = len(self._mmap)
+        line = self._mmap[start:end].decode('UTF-8').rstrip('\r')
+        return dict(zip(self.fieldnames, next(csv.reader((line,), delimiter='|'))))
+
+    def close(self):
+        '''Unmap the CSV file.'''
+        self._mmap.close()
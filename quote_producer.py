@@ -0,0 +1,190 @@
+'''Renders quotes in a background thread, ahead of the minutes that they are for.
+
+Rendering a quote takes a noticeable amount of time (finding its font size, drawing it, then
+encoding it into the screen's format), so the clock shouldn't do it between waking up and updating
+the screen. Instead, a `QuoteProducer` keeps a `FrameBuffer` of frames for the coming minutes
+filled, and the clock only takes the frame for the minute that is starting:
+- The buffer is a ring with a fixed number of slots, one per minute, so the frame for a minute is
+  found without searching. Once the slot for the next minute is taken, the producer waits until the
+  clock takes a frame (back-pressure), so it never renders more than `capacity` minutes ahead.
+- Frames for minutes that have already passed (e.g., minutes that the clock missed) are thrown
+  away when the clock takes a frame.
+- If the frame that the clock needs isn't ready, the clock renders it itself. Only if the producer
+  has fallen behind (e.g., the clock missed some minutes) is it restarted from the next minute;
+  otherwise, the frames that it has rendered for later minutes are kept.
+'''
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from constants import BUFFER_SIZE
+from displays import Frame
+from quote_index import MINUTES_PER_DAY, minute_of_day
+
+
+class FrameBuffer:
+    '''A ring of frames, with one slot per minute, keyed by the minute of the day.
+
+    The slot for a minute is its minute of the day modulo `capacity`. `capacity` is rounded down to
+    a divisor of the number of minutes in a day, so the slots wrap around evenly at midnight and
+    `capacity` consecutive minutes never share a slot. Each slot also stores the minute (with its
+    date) that its frame is for, so a frame that was left over from an earlier minute is never
+    mistaken for a later one.
+
+    Attributes:
+        capacity (int): The number of slots.
+        slots (list[tuple[datetime, Frame] | None]): Each slot's minute and frame.
+        hits (int): The number of lookups that found the minute's frame.
+        misses (int): The number of lookups that didn't find the minute's frame.
+        evicted (int): The number of frames that were thrown away without being looked up.
+    '''
+    def __init__(self, capacity:int = BUFFER_SIZE):
+        self.capacity = min(max(1, capacity), MINUTES_PER_DAY)
+        while MINUTES_PER_DAY % self.capacity:
+            self.capacity -= 1
+        if self.capacity != capacity:
+            logging.warning('A buffer of %i minutes does not divide the %i minutes in a day; '
+                            'using %i.', capacity, MINUTES_PER_DAY, self.capacity)
+        self.slots: list[Optional[tuple[datetime, Frame]]] = [None] * self.capacity
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return sum(slot is not None for slot in self.slots)
+
+    def slot(self, minute:datetime) -> int:
+        '''Return the index of the slot for `minute`.'''
+        return minute_of_day(minute.hour, minute.minute) % self.capacity
+
+    def is_free(self, minute:datetime) -> bool:
+        '''Check if the slot for `minute` is empty.'''
+        return self.slots[self.slot(minute)] is None
+
+    def put(self, minute:datetime, frame:Frame):
+        '''Store the frame for `minute`, replacing whatever was in its slot.'''
+        index = self.slot(minute)
+        self.evicted += self.slots[index] is not None
+        self.slots[index] = (minute, frame)
+
+    def get(self, minute:datetime) -> Optional[Frame]:
+        '''Return the frame for `minute` without removing it, or `None` if it isn't buffered.'''
+        entry = self.slots[self.slot(minute)]
+        return entry[1] if entry is not None and entry[0] == minute else None
+
+    def pop(self, minute:datetime) -> Optional[Frame]:
+        '''Remove and return the frame for `minute`, counting a hit or a miss.'''
+        frame = self.get(minute)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.slots[self.slot(minute)] = None
+        return frame
+
+    def evict(self, before:datetime) -> int:
+        '''Throw away the frames for minutes before `before`, and return how many there were.'''
+        count = 0
+        for index, entry in enumerate(self.slots):
+            if entry is not None and entry[0] < before:
+                self.slots[index] = None
+                count += 1
+        self.evicted += count
+        return count
+
+    def clear(self):
+        '''Throw away every frame.'''
+        self.evicted += len(self)
+        self.slots = [None] * self.capacity
+
+
+class QuoteProducer:
+    '''Keeps a `FrameBuffer` of frames for the coming minutes filled, in a background thread.
+
+    Attributes:
+        render (Callable[[datetime], Frame]): Renders and encodes the frame for a minute. Called in
+         the producer's thread only.
+        frames (FrameBuffer): The frames that are ready, keyed by the minute that they're for.
+        rendered (int): The number of frames that have been rendered.
+    '''
+    def __init__(self, render:Callable[[datetime], Frame], capacity:int = BUFFER_SIZE):
+        self.render = render
+        self.frames = FrameBuffer(capacity)
+        self.rendered = 0
+        self._next_minute: Optional[datetime] = None
+        self._generation = 0 # incremented on restart, so that frames in progress are thrown away
+        self._running = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='QuoteProducer', daemon=True)
+
+    def start(self, minute:datetime):
+        '''Start rendering frames, beginning with the one for `minute`.'''
+        self._next_minute = minute
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop rendering frames. A frame that is being rendered is finished, then thrown away.'''
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def restart(self, minute:datetime):
+        '''Throw away the buffered frames, and start rendering again from `minute`.'''
+        with self._cond:
+            self.frames.clear()
+            self._next_minute = minute
+            self._generation += 1
+            self._cond.notify_all()
+
+    def is_behind(self, minute:datetime) -> bool:
+        '''Check if the producer hasn't started rendering the frames after `minute` yet.'''
+        with self._cond:
+            return self._next_minute is None or self._next_minute <= minute
+
+    def take(self, minute:datetime, timeout:float = 0.0) -> Optional[Frame]:
+        '''Take the frame for `minute` out of the buffer, waiting up to `timeout` seconds for it.
+
+        Frames for earlier minutes are thrown away.
+
+        Returns:
+            frame (Frame | None): The frame for `minute`, or `None` if it isn't ready in time.
+        '''
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self.frames.evict(minute):
+                self._cond.notify_all() # there's room for more frames
+            self._cond.wait_for(lambda: self.frames.get(minute) is not None,
+                                max(0.0, deadline - time.monotonic()))
+            frame = self.frames.pop(minute)
+            if frame is not None:
+                self._cond.notify_all()
+            return frame
+
+    def _run(self):
+        '''Render frames until the producer is stopped, waiting whenever the buffer is full.'''
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: not self._running or self.frames.is_free(self._next_minute))
+                if not self._running:
+                    return
+                generation, minute = self._generation, self._next_minute
+                self._next_minute += timedelta(minutes=1)
+
+            try:
+                frame = self.render(minute)
+            except Exception as e: # pylint: disable=broad-except
+                # the clock renders this minute's frame itself, rather than the producer dying
+                logging.error('Unable to render quote for %s: %s', minute.strftime('%H:%M'), str(e))
+                continue
+
+            with self._cond:
+                self.rendered += 1
+                if generation != self._generation:
+                    self.frames.evicted += 1
+                    continue
+                self.frames.put(minute, frame)
+                self._cond.notify_all()
@@ -0,0 +1,116 @@
+'''Wakes the clock up just before each minute starts, so that each quote is on the screen at :00.
+
+Sleeping for `59 - datetime.now().second` seconds drifts: the time spent rendering and refreshing
+the screen isn't made up for, fractions of a second are ignored, and a slow refresh can skip or
+repeat a minute. Instead, the scheduler:
+- works out when the next minute starts on the wall clock, then sleeps until then on the monotonic
+  clock, which can't be moved by NTP or daylight saving time.
+- wakes up early by the lead time, an average of how long recent screen updates took, so that the
+  update finishes at :00 rather than starting at it.
+- checks the wall clock while sleeping, and starts over if it jumps (e.g., NTP syncing the Pi's
+  clock after it boots, or daylight saving time starting or ending). Minutes that were missed
+  (e.g., because an update took longer than a minute) are counted and logged.
+'''
+from datetime import datetime, timedelta
+import logging
+import time
+from typing import Callable, Optional
+
+from constants import LEAD_TIME, MAX_LEAD_TIME, CLOCK_JUMP_TOLERANCE
+
+MAX_SLEEP = 10 # the longest that the scheduler sleeps between checks of the wall clock, in seconds
+LATENCY_WEIGHT = 0.3 # how much the latest update's time counts towards the lead time
+
+
+class MinuteScheduler:
+    '''Sleeps until it's time to start updating the screen for the next minute.
+
+    Attributes:
+        lead_time (float): How long before each minute to start updating the screen, in seconds.
+        max_lead_time (float): The longest that the lead time can get, in seconds.
+        last_minute (datetime | None): The last minute that `wait()` returned.
+        missed_minutes (int): The number of minutes that were skipped.
+        clock_jumps (int): The number of times that the wall clock jumped or its UTC offset changed.
+    '''
+    def __init__(self, lead_time:float = LEAD_TIME, max_lead_time:float = MAX_LEAD_TIME,
+                 wall:Callable[[], float] = time.time,
+                 monotonic:Callable[[], float] = time.monotonic,
+                 sleep:Callable[[float], None] = time.sleep):
+        self.lead_time = lead_time
+        self.max_lead_time = max_lead_time
+        self.last_minute: Optional[datetime] = None
+        self.missed_minutes = 0
+        self.clock_jumps = 0
+        self._wall, self._monotonic, self._sleep = wall, monotonic, sleep
+        self._offset = self._wall() - self._monotonic()
+        self._utc_offset = time.localtime(self._wall()).tm_gmtoff
+
+    def check_clock(self) -> bool:
+        '''Check if the wall clock jumped (or its UTC offset changed) since the last check.'''
+        offset = self._wall() - self._monotonic()
+        utc_offset = time.localtime(self._wall()).tm_gmtoff
+        jumped = False
+        if abs(offset - self._offset) > CLOCK_JUMP_TOLERANCE:
+            logging.warning('The system clock jumped by %+.1f s.', offset - self._offset)
+            jumped = True
+        if utc_offset != self._utc_offset:
+            logging.warning('The UTC offset changed from %+i s to %+i s (daylight saving time?).',
+                            self._utc_offset, utc_offset)
+            jumped = True
+        self._offset, self._utc_offset = offset, utc_offset
+        self.clock_jumps += jumped
+        return jumped
+
+    def next_minute(self) -> datetime:
+        '''Return the next minute that starts more than `lead_time` seconds from now, other than
+        the last one (which may not have started yet if its update finished early).'''
+        now = datetime.fromtimestamp(self._wall() + self.lead_time)
+        minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        if minute == self.last_minute:
+            minute += timedelta(minutes=1)
+        return minute
+
+    def wait(self) -> datetime:
+        '''Sleep until `lead_time` seconds before the next minute starts.
+
+        Returns:
+            minute (datetime): The minute that is about to start, i.e., the one to display.
+        '''
+        self.check_clock()
+        waiting = True
+        while waiting:
+            minute = self.next_minute()
+            deadline = self._monotonic() + minute.timestamp() - self.lead_time - self._wall()
+            waiting = False
+            while (remaining := deadline - self._monotonic()) > 0:
+                self._sleep(min(remaining, MAX_SLEEP))
+                if self.check_clock():
+                    waiting = True # the deadline is off by however far the clock jumped
+                    break
+
+        if self.last_minute is not None:
+            missed = round((minute.timestamp() - self.last_minute.timestamp()) / 60) - 1
+            if missed > 0:
+                logging.warning('Missed %i minute(s) after %s.', missed,
+                                self.last_minute.strftime('%H:%M'))
+                self.missed_minutes += missed
+            elif missed < 0:
+                logging.warning('The clock went back from %s to %s.',
+                                self.last_minute.strftime('%H:%M'), minute.strftime('%H:%M'))
+        self.last_minute = minute
+        return minute
+
+    def record_update(self, minute:datetime, seconds:float):
+        '''Adjust the lead time to how long the screen took to show the quote for `minute`.
+
+        Args:
+            minute (datetime): The minute that the screen was updated for.
+            seconds (float): How long it took from starting the update until the screen showed the
+             quote (not counting putting the screen to sleep afterwards).
+        '''
+        late = self._wall() - minute.timestamp()
+        logging.info('Quote for %s appeared %.2f s %s the minute (update took %.2f s).',
+                     minute.strftime('%H:%M'), abs(late), 'after' if late > 0 else 'before',
+                     seconds)
+        self.lead_time += LATENCY_WEIGHT * (seconds - self.lead_time)
+        self.lead_time = min(max(self.lead_time, 0.0), self.max_lead_time)
@@ -28,8 +28,14 @@
 #
 
 
+import functools
 import logging
+import time
 from waveshare_libraries import epdconfig
+# The same tables that frame_format.py encodes stored frames with: INVERT flips every bit of a byte
+# (with bytes.translate()), and the GRAY_PLANE tables turn an 8-bit image into the bit planes of
+# display_4Gray() (with Image.point())
+from frame_format import INVERT, GRAY_PLANE_OLD, GRAY_PLANE_NEW
 
 # Display resolution
 EPD_WIDTH       = 800
@@ -40,8 +46,39 @@ GRAY2  = 0xC0
 GRAY3  = 0x80 #gray
 GRAY4  = 0x00 #Blackest
 
+BUSY_TIMEOUT = 30 # seconds to wait for the panel before giving up (a full refresh takes ~4 s)
+BUSY_STATUS_INTERVAL = 1 # seconds between status commands (0x71) while waiting
+
 logger = logging.getLogger(__name__)
-epdconfig = epdconfig.RaspberryPi()
+epdconfig = epdconfig.implementation()
+
+def instrumented(method):
+    # Log the SPI traffic, busy wait, and wall time of each call to an EPD method, and add them to
+    # the EPD's stats, keyed by the method's name
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        spi_bytes, spi_transfers = epdconfig.spi_bytes, epdconfig.spi_transfers
+        spi_time, busy_time = epdconfig.spi_time, self.busy_time
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            call = {
+                'calls': 1,
+                'bytes': epdconfig.spi_bytes - spi_bytes,
+                'transfers': epdconfig.spi_transfers - spi_transfers,
+                'spi_time': epdconfig.spi_time - spi_time,
+                'busy_time': self.busy_time - busy_time,
+                'wall_time': time.perf_counter() - start,
+            }
+            stats = self.stats.setdefault(method.__name__, dict.fromkeys(call, 0))
+            for key, value in call.items():
+                stats[key] += value
+            logger.debug("%s: %d bytes in %d transfers, %.1f ms SPI, %.1f ms busy, %.1f ms total",
+                         method.__name__, call['bytes'], call['transfers'], call['spi_time'] * 1000,
+                         call['busy_time'] * 1000, call['wall_time'] * 1000)
+    return wrapper
+
 class EPD:
     def __init__(self):
         self.reset_pin = epdconfig.RST_PIN
@@ -54,6 +91,18 @@ class EPD:
         self.GRAY2  = GRAY2
         self.GRAY3  = GRAY3 #gray
         self.GRAY4  = GRAY4 #Blackest
+        # Buffers that are reused for every frame, instead of building a new list each minute
+        self.frame_size = (self.width + 7) // 8 * self.height
+        self._inverse = bytearray(self.frame_size)
+        self._white = b'\xff' * self.frame_size
+        self._black = bytes(self.frame_size)
+        # Time spent waiting for the panel in ReadBusy()
+        self.busy_waits = 0
+        self.busy_timeouts = 0
+        self.busy_time = 0.0
+        self.last_busy_time = 0.0
+        # SPI traffic and time of each instrumented method, e.g. stats['display']['bytes']
+        self.stats = {}
     
     # Hardware reset
     def reset(self):
@@ -64,10 +113,15 @@ class EPD:
         epdconfig.digital_write(self.reset_pin, 1)
         epdconfig.delay_ms(20)   
 
-    def send_command(self, command):
+    def send_command(self, command, data=None):
+        # The command's parameter bytes (data) are sent in one transfer, instead of one send_data()
+        # call (and DC/CS toggle) per byte
         epdconfig.digital_write(self.dc_pin, 0)
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([command])
+        if data:
+            epdconfig.digital_write(self.dc_pin, 1)
+            epdconfig.spi_writebyte(data)
         epdconfig.digital_write(self.cs_pin, 1)
 
     def send_data(self, data):
@@ -79,82 +133,81 @@ class EPD:
     def send_data2(self, data):
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
-        epdconfig.SPI.writebytes2(data)
+        epdconfig.spi_writebyte2(data)
         epdconfig.digital_write(self.cs_pin, 1)
 
-    def ReadBusy(self):
+    def ReadBusy(self, timeout=BUSY_TIMEOUT):
+        # Sleep until the panel releases BUSY, instead of spinning on digital_read(). The status
+        # command is still sent now and then while waiting, like Waveshare's polling loop did.
         logger.debug("e-Paper busy")
-        self.send_command(0x71)
-        busy = epdconfig.digital_read(self.busy_pin)
-        while(busy == 0):
+        start = time.monotonic()
+        released = False
+        while True:
             self.send_command(0x71)
-            busy = epdconfig.digital_read(self.busy_pin)
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+            if epdconfig.wait_busy_release(min(BUSY_STATUS_INTERVAL, remaining)):
+                released = True
+                break
+        waited = time.monotonic() - start
+        self.busy_waits += 1
+        self.busy_time += waited
+        self.last_busy_time = waited
+        if released:
+            logger.debug("e-Paper busy release after %.3f s", waited)
+        else:
+            self.busy_timeouts += 1
+            logger.error("e-Paper still busy after %.1f s, continuing anyway", waited)
         epdconfig.delay_ms(20)
-        logger.debug("e-Paper busy release")
         
+    @instrumented
     def init(self):
         if (epdconfig.module_init() != 0):
             return -1
         # EPD hardware init start
         self.reset()
         
-        self.send_command(0x06)     # btst
-        self.send_data(0x17)
-        self.send_data(0x17)
-        self.send_data(0x28)        # If an exception is displayed, try using 0x38
-        self.send_data(0x17)
+        # btst -- if an exception is displayed, try using 0x38 for the third byte
+        self.send_command(0x06, [0x17, 0x17, 0x28, 0x17])
         
-        self.send_command(0x01)			#POWER SETTING
-        self.send_data(0x07)
-        self.send_data(0x07)    #VGH=20V,VGL=-20V
-        self.send_data(0x28)		#VDH=15V
-        self.send_data(0x17)		#VDL=-15V
+        #POWER SETTING: VGH=20V,VGL=-20V, VDH=15V, VDL=-15V
+        self.send_command(0x01, [0x07, 0x07, 0x28, 0x17])
 
         self.send_command(0x04) #POWER ON
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
+        self.send_command(0X00, [0x1F]) #PANNEL SETTING   KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
 
-        self.send_command(0x61)        	#tres
-        self.send_data(0x03)		#source 800
-        self.send_data(0x20)
-        self.send_data(0x01)		#gate 480
-        self.send_data(0xE0)
+        self.send_command(0x61, [0x03, 0x20, 0x01, 0xE0]) #tres: source 800, gate 480
 
-        self.send_command(0X15)
-        self.send_data(0x00)
+        self.send_command(0X15, [0x00])
 
         # If the screen appears gray, use the annotated initialization command
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
+        self.send_command(0X50, [0x10, 0x07])
         # self.send_command(0X50)
         # self.send_data(0x10)
         # self.send_data(0x17)
         # self.send_command(0X52)		
         # self.send_data(0x03)
 
-        self.send_command(0X60)			#TCON SETTING
-        self.send_data(0x22)
+        self.send_command(0X60, [0x22]) #TCON SETTING
 
         # EPD hardware init end
         return 0
     
+    @instrumented
     def init_fast(self):
         if (epdconfig.module_init() != 0):
             return -1
         # EPD hardware init start
         self.reset()
         
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
+        self.send_command(0X00, [0x1F]) #PANNEL SETTING   KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
 
         # If the screen appears gray, use the annotated initialization command
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
+        self.send_command(0X50, [0x10, 0x07])
         # self.send_command(0X50)
         # self.send_data(0x10)
         # self.send_data(0x17)
@@ -166,70 +219,54 @@ class EPD:
         self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
 
         #Enhanced display drive(Add 0x06 command)
-        self.send_command(0x06)			#Booster Soft Start 
-        self.send_data (0x27)
-        self.send_data (0x27)   
-        self.send_data (0x18)		
-        self.send_data (0x17)		
+        self.send_command(0x06, [0x27, 0x27, 0x18, 0x17]) #Booster Soft Start
 
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x5A)
+        self.send_command(0xE0, [0x02])
+        self.send_command(0xE5, [0x5A])
 
         # EPD hardware init end
         return 0
     
+    @instrumented
     def init_part(self):
         if (epdconfig.module_init() != 0):
             return -1
         # EPD hardware init start
         self.reset()
 
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
+        self.send_command(0X00, [0x1F]) #PANNEL SETTING   KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
 
         self.send_command(0x04) #POWER ON
         epdconfig.delay_ms(100) 
         self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
 
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x6E)
+        self.send_command(0xE0, [0x02])
+        self.send_command(0xE5, [0x6E])
 
         # EPD hardware init end
         return 0
     
     # The feature will only be available on screens sold after 24/10/23
+    @instrumented
     def init_4Gray(self):
         if (epdconfig.module_init() != 0):
             return -1
         # EPD hardware init start
         self.reset()
 
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
+        self.send_command(0X00, [0x1F]) #PANNEL SETTING   KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
         
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
+        self.send_command(0X50, [0x10, 0x07])
 
         self.send_command(0x04) #POWER ON
         epdconfig.delay_ms(100) 
         self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
 
         #Enhanced display drive(Add 0x06 command)
-        self.send_command(0x06)			#Booster Soft Start 
-        self.send_data (0x27)
-        self.send_data (0x27)   
-        self.send_data (0x18)		
-        self.send_data (0x17)	
+        self.send_command(0x06, [0x27, 0x27, 0x18, 0x17]) #Booster Soft Start
 
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x5F)
+        self.send_command(0xE0, [0x02])
+        self.send_command(0xE5, [0x5F])
 
         # EPD hardware init end
         return 0
@@ -245,63 +282,54 @@ class EPD:
         else:
             logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
-            return [0x00] * (int(self.width/8) * self.height)
+            return bytes(int(self.width/8) * self.height)
 
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
-        # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
-        return buf
+        # in the e-paper world 0=white and 1=black. translate() inverts all of them in one C pass,
+        # and the resulting bytes object can be passed straight to send_data2().
+        return img.tobytes('raw').translate(INVERT)
     
     def getbuffer_4Gray(self, image):
-        # logger.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width / 4) * self.height)
-        image_monocolor = image.convert('L')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        i=0
-        # logger.debug("imwidth = %d, imheight = %d",imwidth,imheight)
+        # Returns the two bit planes that display_4Gray() sends to the panel, one after the other
+        # (RAM 0x10, then RAM 0x13), each packed 1 bit per pixel. Pillow maps every pixel through
+        # a lookup table straight into a 1-bit image, so no pixel is touched in Python.
+        img = image.convert('L')
+        imwidth, imheight = img.size
         if(imwidth == self.width and imheight == self.height):
             logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((x + (y * self.width))/4)] = ((pixels[x-3, y]&0xc0) | (pixels[x-2, y]&0xc0)>>2 | (pixels[x-1, y]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6)
-                        
         elif(imwidth == self.height and imheight == self.width):
             logger.debug("Horizontal")
-            for x in range(imwidth):
-                for y in range(imheight):
-                    newx = y
-                    newy = self.height - x - 1
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((newx + (newy * self.width))/4)] = ((pixels[x, y-3]&0xc0) | (pixels[x, y-2]&0xc0)>>2 | (pixels[x, y-1]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6) 
-        return buf
-
-    def display(self, image):
-        if(self.width % 8 == 0):
-            Width = self.width // 8
+            img = img.rotate(90, expand=True)
         else:
-            Width = self.width // 8 +1
-        Height = self.height
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~image[i + j * Width]
+            logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
+            # return a blank (white) buffer
+            return bytes(self.frame_size * 2)
+        return (img.point(GRAY_PLANE_OLD, '1').tobytes('raw')
+                + img.point(GRAY_PLANE_NEW, '1').tobytes('raw'))
+
+    def invert(self, data, size=None):
+        # Invert the first size bytes of a buffer (bytes, bytearray, memoryview, or list) into the
+        # start of a full-frame bytearray that is reused from frame to frame, and return a
+        # memoryview of them, so a partial window doesn't need a buffer of its own. translate()
+        # inverts them in one C pass.
+        if size is None:
+            size = len(data)
+        if not isinstance(data, (bytes, bytearray)) or len(data) != size:
+            data = bytes(data[:size])
+        if size > len(self._inverse):
+            self._inverse = bytearray(size)
+        inverse = memoryview(self._inverse)[:size]
+        inverse[:] = data.translate(INVERT)
+        return inverse
+
+    @instrumented
+    def display(self, image):
+        # image is the buffer from getbuffer(); the old data is its inverse, the new data is
+        # sent as-is, without being copied
+        if not isinstance(image, (bytes, bytearray, memoryview)):
+            image = bytes(image)
         self.send_command(0x10)
-        self.send_data2(image1)
+        self.send_data2(self.invert(image))
 
         self.send_command(0x13)
         self.send_data2(image)
@@ -310,17 +338,19 @@ class EPD:
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
+    @instrumented
     def Clear(self):
         self.send_command(0x10)
-        self.send_data2([0xFF] * int(self.width * self.height / 8))
+        self.send_data2(self._white)
         self.send_command(0x13)
-        self.send_data2([0x00] * int(self.width * self.height / 8))
+        self.send_data2(self._black)
 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-    def display_Partial(self, Image, Xstart, Ystart, Xend, Yend):
+    @instrumented
+    def display_Partial(self, Image, Xstart, Ystart, Xend, Yend, Previous=None):
         if((Xstart % 8 + Xend % 8 == 8 & Xstart % 8 > Xend % 8) | Xstart % 8 + Xend % 8 == 0 | (Xend - Xstart)%8 == 0):
             Xstart = Xstart // 8 * 8
             Xend = Xend // 8 * 8
@@ -334,115 +364,55 @@ class EPD:
         Width = (Xend - Xstart) // 8
         Height = Yend - Ystart
 	
-        self.send_command(0x50)
-        self.send_data(0xA9)
-        self.send_data(0x07)
+        self.send_command(0x50, [0xA9, 0x07])
 
         self.send_command(0x91)		#This command makes the display enter partial mode
-        self.send_command(0x90)		#resolution setting
-        self.send_data (Xstart//256)
-        self.send_data (Xstart%256)   #x-start    
-
-        self.send_data ((Xend-1)//256)		
-        self.send_data ((Xend-1)%256)  #x-end	
-
-        self.send_data (Ystart//256)  #
-        self.send_data (Ystart%256)   #y-start    
-
-        self.send_data ((Yend-1)//256)		
-        self.send_data ((Yend-1)%256)  #y-end
-        self.send_data (0x01)
-
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~Image[i + j * Width]
+        self.send_command(0x90, [    #resolution setting
+            Xstart//256, Xstart%256,            #x-start
+            (Xend-1)//256, (Xend-1)%256,        #x-end
+            Ystart//256, Ystart%256,            #y-start
+            (Yend-1)//256, (Yend-1)%256,        #y-end
+            0x01])
+
+        # Image holds the window's rows, Width bytes each; only the window's bytes are sent.
+        # Previous is what the window shows now, in the same layout. The panel only drives the
+        # pixels that differ from RAM 0x10, which is lost in deep sleep, so it is written first.
+        if Previous is not None:
+            self.send_command(0x10)
+            self.send_data2(self.invert(Previous, Width * Height))
 
         self.send_command(0x13)   #Write Black and White image to RAM
-        self.send_data2(image1)
+        self.send_data2(self.invert(Image, Width * Height))
 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
+    @instrumented
     def display_4Gray(self, image):
+        # image is the buffer from getbuffer_4Gray(); each plane is sent in one transfer
+        if not isinstance(image, (bytes, bytearray, memoryview)):
+            image = bytes(image)
+        planes = memoryview(image)
+        plane_size = len(image) // 2
         self.send_command(0x10)
-        for i in range(0, 48000):     
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x01  
-                    elif(temp2 == 0x80): 
-                        temp3 |= 0x01 
-                    else: #0x40
-                        temp3 |= 0x00 
-                    temp3 <<= 1	
-                    
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0): 
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00): 
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x01
-                    else :   #0x40
-                        temp3 |= 0x00	
-                    if(j!=1 or k!=1):				
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
-            
-        self.send_command(0x13)	       
-        for i in range(0, 48000):       
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00
-                    else: #0x40
-                        temp3 |= 0x01 
-                    temp3 <<= 1	
-                    
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0): 
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00): 
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00 
-                    else:    #0x40
-                            temp3 |= 0x01	
-                    if(j!=1 or k!=1):					
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
-        
+        self.send_data2(planes[:plane_size])
+
+        self.send_command(0x13)
+        self.send_data2(planes[plane_size:])
+
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
+    @instrumented
     def sleep(self):
-        self.send_command(0x50)
-        self.send_data(0XF7)
+        self.send_command(0x50, [0xF7])
         
         self.send_command(0x02) # POWER_OFF
         self.ReadBusy()
         
-        self.send_command(0x07) # DEEP_SLEEP
-        self.send_data(0XA5)
+        self.send_command(0x07, [0xA5]) # DEEP_SLEEP
         
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
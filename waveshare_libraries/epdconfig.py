@@ -34,9 +34,16 @@ import time
 import subprocess
 
 from ctypes import *
+from PIL import Image, ImageChops
 
 logger = logging.getLogger(__name__)
 
+try:
+    from constants import SPI_SPEED_HZ, EPD_BACKEND
+except ImportError: # the library is used on its own
+    SPI_SPEED_HZ = 4000000
+    EPD_BACKEND = 'hardware'
+
 
 class RaspberryPi:
     # Pin definition
@@ -59,7 +66,13 @@ class RaspberryPi:
         self.GPIO_PWR_PIN    = gpiozero.LED(self.PWR_PIN)
         self.GPIO_BUSY_PIN   = gpiozero.Button(self.BUSY_PIN, pull_up = False)
 
-        
+        self.reset_spi_stats()
+
+    def reset_spi_stats(self):
+        # SPI traffic since the module was loaded (or since the last reset)
+        self.spi_bytes = 0
+        self.spi_transfers = 0
+        self.spi_time = 0.0
 
     def digital_write(self, pin, value):
         if pin == self.RST_PIN:
@@ -98,11 +111,28 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_busy_release(self, timeout):
+        # Block until the BUSY pin goes high (the panel is idle) without polling: gpiozero wakes
+        # this thread on the pin's edge. Returns False if the timeout (in seconds) runs out first.
+        return self.GPIO_BUSY_PIN.wait_for_press(timeout)
+
     def spi_writebyte(self, data):
+        start = time.perf_counter()
         self.SPI.writebytes(data)
+        self.spi_time += time.perf_counter() - start
+        self.spi_bytes += len(data)
+        self.spi_transfers += 1
 
     def spi_writebyte2(self, data):
+        # Send a large payload without copying it; spidev's writebytes2 splits it into transfers
+        # that fit its bufsiz itself
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)
+        start = time.perf_counter()
         self.SPI.writebytes2(data)
+        self.spi_time += time.perf_counter() - start
+        self.spi_bytes += len(data)
+        self.spi_transfers += 1
 
     def DEV_SPI_write(self, data):
         self.DEV_SPI.DEV_SPI_SendData(data)
@@ -141,7 +171,7 @@ class RaspberryPi:
         else:
             # SPI device, bus = 0, device = 0
             self.SPI.open(0, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = SPI_SPEED_HZ
             self.SPI.mode = 0b00
         return 0
 
@@ -160,3 +190,237 @@ class RaspberryPi:
             # self.GPIO_CS_PIN.close()
             self.GPIO_PWR_PIN.close()
             self.GPIO_BUSY_PIN.close()
+
+
+class MockPanel:
+    # A simulated 7.5" V2 panel. It records every command and its data, holds BUSY low for about as
+    # long as the real panel would, and rebuilds the image that the panel would show.
+    #
+    # Time spent busy, in seconds, for each kind of refresh (0x12) and for power on/off
+    BUSY_TIMES = {'full': 3.5, 'fast': 1.5, 'partial': 0.4, '4gray': 2.0,
+                  'power_on': 0.1, 'power_off': 0.05}
+
+    def __init__(self, width=800, height=480, time_scale=1.0):
+        self.width = width
+        self.height = height
+        self.time_scale = time_scale # 0 makes the panel never busy
+        self.row_bytes = (width + 7) // 8
+        self.ram = {0x10: bytearray(self.row_bytes * height),
+                    0x13: bytearray(self.row_bytes * height)}
+        self.screen = Image.new('L', (width, height), 0xFF) # what the panel shows
+        self.commands = [] # [command, bytearray of its data]
+        self.command_counts = {}
+        self.refresh_counts = {}
+        self.data_bytes = 0
+        self.busy_until = 0.0
+        self.busy_time = 0.0
+        self.reset()
+
+    def reset(self):
+        # The controller's registers go back to their defaults when RST is pulled low
+        self.polarity = 0x10 # first byte of the last 0x50 (VCOM and data interval) command
+        self.mode = 0x00 # parameter of the last 0xE5 command, which picks the waveform
+        self.partial = False
+        self.window = (0, 0, self.width, self.height)
+        self._offsets = {0x10: 0, 0x13: 0}
+
+    def busy(self):
+        return time.monotonic() < self.busy_until
+
+    def set_busy(self, kind):
+        seconds = self.BUSY_TIMES[kind] * self.time_scale
+        self.busy_time += seconds
+        self.busy_until = time.monotonic() + seconds
+
+    def write(self, dc, data):
+        if dc == 0:
+            for command in data:
+                self.command(command)
+        else:
+            self.data(data)
+
+    def command(self, command):
+        self.commands.append([command, bytearray()])
+        self.command_counts[command] = self.command_counts.get(command, 0) + 1
+        if command in self._offsets:
+            self._offsets[command] = 0
+        elif command == 0x91:
+            self.partial = True
+        elif command == 0x92:
+            self.partial = False
+        elif command == 0x04:
+            self.set_busy('power_on')
+        elif command == 0x02:
+            self.set_busy('power_off')
+        elif command == 0x12:
+            self.refresh()
+
+    def data(self, data):
+        self.data_bytes += len(data)
+        if not self.commands:
+            return
+        command, params = self.commands[-1]
+        if command in self._offsets:
+            self.write_ram(command, data)
+            return
+        params += data
+        if command == 0x50:
+            self.polarity = params[0]
+        elif command == 0xE5:
+            self.mode = params[0]
+        elif command == 0x07 and params[0] == 0xA5: # deep sleep: the RAM's contents are lost
+            for ram in self.ram.values():
+                ram[:] = bytes(len(ram))
+        elif command == 0x90 and len(params) >= 8:
+            x_start, x_end, y_start, y_end = (params[i] << 8 | params[i + 1]
+                                              for i in range(0, 8, 2))
+            self.window = (x_start, y_start, x_end + 1, y_end + 1)
+
+    def area(self):
+        # The part of the panel that is written to and refreshed
+        return self.window if self.partial else (0, 0, self.width, self.height)
+
+    def write_ram(self, command, data):
+        # Data fills the area's rows from the top left
+        x_start, y_start, x_end, y_end = self.area()
+        left, right = x_start // 8, (x_end + 7) // 8
+        ram, offset = self.ram[command], self._offsets[command]
+        for value in data:
+            row, col = divmod(offset, right - left)
+            if y_start + row >= y_end:
+                break
+            ram[(y_start + row) * self.row_bytes + left + col] = value
+            offset += 1
+        self._offsets[command] = offset
+
+    def refresh(self):
+        if self.mode == 0x5F:
+            kind = '4gray'
+        elif self.partial:
+            kind = 'partial'
+        elif self.mode == 0x5A:
+            kind = 'fast'
+        else:
+            kind = 'full'
+        self.refresh_counts[kind] = self.refresh_counts.get(kind, 0) + 1
+        size = (self.row_bytes * 8, self.height)
+        # 255 where a bit is set
+        new = Image.frombytes('1', size, bytes(self.ram[0x13])).convert('L')
+        if kind == '4gray':
+            # each pixel's level is picked by its bit in both RAMs (see EPD.getbuffer_4Gray())
+            old = Image.frombytes('1', size, bytes(self.ram[0x10])).convert('L')
+            levels = ImageChops.add(old.point([0] * 255 + [2]), new.point([0] * 255 + [1]))
+            shown = levels.point([0xFF, 0x80, 0xC0, 0x00] + [0] * 252)
+        elif self.polarity & 0x01: # DDX[0] set: a bit that is set is white
+            shown = new
+        else:
+            shown = ImageChops.invert(new)
+        area = self.area()
+        if kind == 'partial':
+            # only the pixels whose new data (RAM 0x13) differs from the old data (RAM 0x10) are
+            # driven, so a stale RAM 0x10 leaves pixels unchanged
+            old = Image.frombytes('1', size, bytes(self.ram[0x10])).convert('L')
+            driven = ImageChops.difference(old, new).crop(area)
+            self.screen.paste(shown.crop(area), area[:2], driven)
+        else:
+            self.screen.paste(shown.crop(area), area[:2])
+        self.set_busy(kind)
+
+    def image(self):
+        # A copy of what the panel shows, as an 8-bit Pillow image
+        return self.screen.copy()
+
+
+class MockSPI:
+    # Stands in for spidev.SpiDev, passing every transfer to the panel along with the DC pin's state
+    def __init__(self, config):
+        self.config = config
+        self.max_speed_hz = SPI_SPEED_HZ
+        self.mode = 0
+        self.bus_time = 0.0 # how long the transfers would take on the wire at max_speed_hz
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def writebytes(self, data):
+        self.bus_time += len(data) * 8 / self.max_speed_hz
+        self.config.panel.write(self.config.GPIO_DC_PIN.value, bytes(data))
+
+    writebytes2 = writebytes
+
+
+class MockPin:
+    # Stands in for gpiozero.LED and gpiozero.Button
+    def __init__(self, on_change=None):
+        self.value = 0
+        self.on_change = on_change
+
+    def on(self):
+        self.value = 1
+
+    def off(self):
+        if self.value and self.on_change:
+            self.on_change()
+        self.value = 0
+
+    def close(self):
+        pass
+
+
+class MockBusyPin:
+    # Stands in for the BUSY pin's gpiozero.Button: high (1) when the panel is idle
+    def __init__(self, panel):
+        self.panel = panel
+
+    @property
+    def value(self):
+        return 0 if self.panel.busy() else 1
+
+    def wait_for_press(self, timeout=None):
+        remaining = self.panel.busy_until - time.monotonic()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            return False
+        if remaining > 0:
+            time.sleep(remaining)
+        return True
+
+    def close(self):
+        pass
+
+
+class MockPi(RaspberryPi):
+    # Simulates the Pi's SPI bus and GPIO pins with a MockPanel, so that the driver (and the clock)
+    # can run without a Pi or a screen. Select it with EPD_BACKEND = 'mock' in constants.py, or with
+    # the EPD_BACKEND=mock environment variable. EPD_MOCK_TIME_SCALE scales how long the panel is
+    # busy for (e.g., 0 to never wait).
+    def __init__(self, time_scale=None):
+        if time_scale is None:
+            time_scale = float(os.environ.get('EPD_MOCK_TIME_SCALE', 1.0))
+        self.time_scale = time_scale
+        self.panel = MockPanel(time_scale=time_scale)
+        self.SPI = MockSPI(self)
+        self.GPIO_RST_PIN    = MockPin(on_change=self.panel.reset)
+        self.GPIO_DC_PIN     = MockPin()
+        self.GPIO_PWR_PIN    = MockPin()
+        self.GPIO_BUSY_PIN   = MockBusyPin(self.panel)
+        self.reset_spi_stats()
+
+    def delay_ms(self, delaytime):
+        time.sleep(delaytime / 1000.0 * self.time_scale)
+
+    def module_init(self, cleanup=False):
+        self.GPIO_PWR_PIN.on()
+        return 0
+
+
+def implementation():
+    # The backend selected by the EPD_BACKEND environment variable, or by constants.py
+    backend = os.environ.get('EPD_BACKEND', EPD_BACKEND)
+    if backend == 'mock':
+        logger.info("Using the mock e-Paper backend")
+        return MockPi()
+    return RaspberryPi()
@@ -4,15 +4,19 @@ To enable text formatting when text is written onto an image, there is a need to
 of the text as it is written (to ensure it is written in the correct place and does not overlap with
 itself or go beyond the screen).
 
-This module contains dataclasses that define and track delimiting characters for text formatting,
+This module contains dataclasses that define delimiting characters for text formatting, a
+`tokenize()` function that splits formatted text into runs of characters that share a font style,
 and a `Pen` class to track which font and what color to use, when writing and where to write text.
 '''
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, fields
 from enum import Enum
+import threading
+import time
 
 from PIL import ImageFont
 
-from constants import MIN_FONT_SIZE
+from constants import MIN_FONT_SIZE, FONT_CACHE_SIZE
 
 @dataclass
 class FontPath:
@@ -70,13 +74,91 @@ class WordDelimiters:
         '''Return a list of the delimiting characters for word formatting.'''
         return [self.NEWLINE, self.DOUBLE_NEWLINE]
 
-@dataclass
-class Delimiter:
-    '''Defines a formatting delimiter and stores how many of said characters have been seen in a
-    text'''
-    def __init__(self, character:str):
-        self.character:str = character
-        self.count:int = 0
+class FontStyle(Enum):
+    '''Describes which version of the font a run of text is written in.'''
+    REGULAR     = 1
+    ITALIC      = 2
+    BOLD        = 3
+    ITALIC_BOLD = 4
+
+
+@dataclass(frozen=True)
+class Run:
+    '''A piece of a word that is written in one style, with its delimiters removed.'''
+    text:  str
+    style: FontStyle
+
+
+@dataclass(frozen=True)
+class Word:
+    '''A word of text, split into runs that are each written in a single style.
+
+    Attributes:
+        text (str): The word as it appears in the text, including any delimiters.
+        runs (tuple[Run, ...]): The characters to write, grouped into runs of the same style.
+        trailing_style (FontStyle): The style that the space after the word is written in, which is
+         the style that the font was left in after the word's last character (or delimiter).
+    '''
+    text:           str
+    runs:           tuple[Run, ...]
+    trailing_style: FontStyle
+
+
+def tokenize(text:str) -> tuple[Word, ...]:
+    '''Split text into words, and each word into runs of characters that share a font style.
+
+    Text is only tokenized once; the result is then reused for every font size that is tried and
+    for drawing the text, instead of tracking which delimiters are open character-by-character each
+    time. Delimiters always start closed at the beginning of the text.
+
+    - A character is italic if an `ITALIC` delimiter is open, and bold if a `BOLD` or `TIMESTR`
+      delimiter is open (or both).
+    - Delimiting characters are not written. Opening or closing one switches the style to that of
+      the delimiters that are still open; closing the last open delimiter leaves the style as it was
+      until the next character.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        words (tuple[Word, ...]): The words of the text, in order.
+    '''
+    char_delimiters = dir(CharacterDelimiters())
+    word_delimiters = dir(WordDelimiters())
+    is_open = {delimiter: False for delimiter in char_delimiters}
+
+    def open_style() -> FontStyle:
+        bold = is_open[CharacterDelimiters.BOLD] or is_open[CharacterDelimiters.TIMESTR]
+        if is_open[CharacterDelimiters.ITALIC]:
+            return FontStyle.ITALIC_BOLD if bold else FontStyle.ITALIC
+        return FontStyle.BOLD if bold else FontStyle.REGULAR
+
+    words: list[Word] = []
+    style = FontStyle.REGULAR
+    for word in text.split():
+        runs: list[Run] = []
+        run_text = ''
+        run_style = style
+        for char in word:
+            if char in word_delimiters:
+                continue
+            if char in char_delimiters:
+                is_open[char] = not is_open[char]
+                if any(is_open.values()):
+                    style = open_style()
+                continue
+
+            style = open_style()
+            if style != run_style and run_text:
+                runs.append(Run(run_text, run_style))
+                run_text = ''
+            run_style = style
+            run_text += char
+        if run_text:
+            runs.append(Run(run_text, run_style))
+        words.append(Word(word, tuple(runs), style))
+    return tuple(words)
+
 
 @dataclass
 class Fonts:
@@ -87,6 +169,163 @@ class Fonts:
     italic_bold: ImageFont.FreeTypeFont
     credit:      ImageFont.FreeTypeFont
 
+    def get(self, style:FontStyle) -> ImageFont.FreeTypeFont:
+        '''Return the font to write text of the given style in.'''
+        if style == FontStyle.ITALIC:
+            return self.italic
+        if style == FontStyle.BOLD:
+            return self.bold
+        if style == FontStyle.ITALIC_BOLD:
+            return self.italic_bold
+        return self.regular
+
+
+class GlyphAdvances(dict):
+    '''The advance width (in pixels) of each character in a font, looked up by character.
+
+    Widths are truncated to integers exactly like `int(font.getlength(char))`, so text that is
+    measured with this table is laid out identically. Printable ASCII is measured up front, and any
+    other character is measured the first time it is looked up; after that, a lookup is just a
+    `dict` access instead of a call into FreeType.
+
+    Attributes:
+        font (ImageFont.FreeTypeFont): The font that the widths are measured in.
+    '''
+    def __init__(self, font:ImageFont.FreeTypeFont):
+        super().__init__()
+        self.font = font
+        for code in range(0x20, 0x7F):
+            self[chr(code)] = int(font.getlength(chr(code)))
+
+    def __missing__(self, char:str) -> int:
+        width = self[char] = int(self.font.getlength(char))
+        return width
+
+    def text_width(self, text:str) -> int:
+        '''Return the sum of the widths of each character in `text`.'''
+        return sum(map(self.__getitem__, text))
+
+
+class GlyphExtents(dict):
+    '''The horizontal extent (in pixels) of each character's bbox in a font, looked up by character.
+
+    Each entry is `(left, right)`, relative to where the character is written. Characters that leave
+    no ink (e.g., spaces) have an extent of `(0, 0)`.
+
+    Attributes:
+        font (ImageFont.FreeTypeFont): The font that the extents are measured in.
+    '''
+    def __init__(self, font:ImageFont.FreeTypeFont):
+        super().__init__()
+        self.font = font
+
+    def __missing__(self, char:str) -> tuple[int, int]:
+        left, top, right, bottom = self.font.getbbox(char)
+        extent = self[char] = (left, right) if left < right and top < bottom else (0, 0)
+        return extent
+
+
+class FontTables(dict):
+    '''Maps each `FreeTypeFont` to a table of per-character measurements, building the table the
+    first time a font is looked up.'''
+    def __init__(self, table_type:type):
+        super().__init__()
+        self.table_type = table_type
+
+    def __missing__(self, font:ImageFont.FreeTypeFont) -> dict:
+        table = self[font] = self.table_type(font)
+        return table
+
+
+class FontRegistry:
+    '''A process-wide cache of `FreeTypeFont` objects, so that a font file is opened once per size.
+
+    Finding the optimal font size for a single quote needs fonts in several different sizes, and the
+    same sizes come up again for the next quote. Opening a font file with FreeType is slow, so fonts
+    are kept in a least-recently-used cache instead of being opened again each time.
+
+    Attributes:
+        max_fonts (int): The maximum number of `FreeTypeFont` objects to keep.
+        hits (int): The number of times a requested font was already loaded (a cached `Fonts` object
+         counts once for each of its fonts).
+        misses (int): The number of times a font had to be loaded from its file.
+        load_time (float): The total time (in seconds) spent loading fonts from their files.
+        advances (FontTables): The character widths of each loaded font, e.g.,
+         `font_registry.advances[pen.font]['a']`.
+        extents (FontTables): The horizontal extents of the characters of each loaded font.
+        line_heights (dict[ImageFont.FreeTypeFont, int]): The line height of each loaded font (see
+         `image_generator.get_lineheight()`).
+    '''
+    def __init__(self, max_fonts:int = FONT_CACHE_SIZE):
+        self.max_fonts = max_fonts
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0
+        self._fonts: OrderedDict[tuple, ImageFont.FreeTypeFont] = OrderedDict()
+        self._bundles: OrderedDict[int, Fonts] = OrderedDict()
+        self.advances = FontTables(GlyphAdvances)
+        self.extents = FontTables(GlyphExtents)
+        self.line_heights: dict[ImageFont.FreeTypeFont, int] = {}
+        self._lock = threading.Lock()
+
+    def get_font(self, path:str, size:int,
+                 layout:ImageFont.Layout = ImageFont.Layout.BASIC) -> ImageFont.FreeTypeFont:
+        '''Return the font at `path` in the given size, loading it only if it isn't cached.'''
+        key = (path, size, layout)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self.hits += 1
+                self._fonts.move_to_end(key)
+                return font
+
+            self.misses += 1
+            start = time.perf_counter()
+            font = ImageFont.truetype(path, size, layout_engine=layout)
+            self.load_time += time.perf_counter() - start
+            self._fonts[key] = font
+            if len(self._fonts) > self.max_fonts:
+                _, evicted = self._fonts.popitem(last=False)
+                self.advances.pop(evicted, None)
+                self.extents.pop(evicted, None)
+                self.line_heights.pop(evicted, None)
+            return font
+
+    def get_fonts(self, size:int) -> Fonts:
+        '''Return a `Fonts` object with every font that may be used to write text in a size.'''
+        with self._lock:
+            fonts = self._bundles.get(size)
+            if fonts is not None:
+                self.hits += len(fields(Fonts))
+                self._bundles.move_to_end(size)
+                return fonts
+
+        fonts = Fonts(
+            regular=self.get_font(FontPath.REGULAR, size),
+            bold=self.get_font(FontPath.BOLD, size),
+            italic=self.get_font(FontPath.ITALIC, size),
+            italic_bold=self.get_font(FontPath.ITALIC_BOLD, size),
+            credit=self.get_font(FontPath.CREDIT, size)
+        )
+        with self._lock:
+            self._bundles[size] = fonts
+            # a bundle holds on to its fonts, so don't keep more bundles than there are fonts for
+            if len(self._bundles) > max(1, self.max_fonts // 4):
+                self._bundles.popitem(last=False)
+        return fonts
+
+    def hit_rate(self) -> float:
+        '''Return the fraction of font requests that were already loaded.'''
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __repr__(self) -> str:
+        return (f'FontRegistry(fonts={len(self._fonts)}, hits={self.hits}, misses={self.misses}, '
+                f'hit_rate={self.hit_rate():.1%}, load_time={self.load_time * 1000:.1f}ms)')
+
+
+font_registry = FontRegistry()
+
 
 @dataclass
 class BoundingBox:
@@ -114,25 +353,18 @@ class Pen:
         bbox (BoundingBox): An area that the pen must write inside of. The bbox should be
          overwritten after a new pen is made (default coords are (0,0)(0,0)).
         coords (dict): Stores the X and Y coordinates of the pen's location on the image.
-        char_delimiters (list[Delimiter]): A list of all delimiters that are used to format
-         characters.
     '''
     def __init__(self):
-        self.font = ImageFont.truetype(FontPath.REGULAR, MIN_FONT_SIZE, ImageFont.Layout.BASIC)
+        self.font = font_registry.get_font(FontPath.REGULAR, MIN_FONT_SIZE)
         self.color = 128
         self.text_type = TextType.QUOTE
         self.text: str = ''
         self.bbox = BoundingBox(0,0,0,0)
         self.coords: dict = {'x':0, 'y':0}
-        self.char_delimiters: list[Delimiter] = [
-            Delimiter(CharacterDelimiters.ITALIC),
-            Delimiter(CharacterDelimiters.BOLD),
-            Delimiter(CharacterDelimiters.TIMESTR)
-            ]
 
 
     def reset(self, x_pos:int, y_pos:int):
-        '''Move the pen and set all delimiter counters to 0.
+        '''Move the pen.
         
         Args:
             x_pos (int): The X coordinate to move the pen to.
@@ -140,5 +372,3 @@ class Pen:
         '''
         self.coords['x'] = x_pos
         self.coords['y'] = y_pos
-        for delimiter in self.char_delimiters:
-            delimiter.count = 0